@@ -0,0 +1,123 @@
+"""
+Asyncio execution path for manticore database.
+
+Queries are compiled with usual compilers and executed with aiomysql
+connection pool, one pool per database alias and event loop. With HOSTS
+setting there is a pool per node, nodes are chosen and marked down by the
+same multi-host pool which is used for sync connections.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Optional
+from weakref import WeakKeyDictionary
+
+from django.core.exceptions import ImproperlyConfigured
+
+from manticore.backend.pool import Host
+
+try:
+    import aiomysql
+except ImportError:  # pragma: no cover
+    aiomysql = None
+
+# event loop -> {(database alias, host, port) -> pool future}
+_pools = WeakKeyDictionary()
+
+
+def get_pool_params(connection, host: Optional[Host] = None):
+    """
+    Transforms database settings to aiomysql connection parameters.
+
+    :param connection: database wrapper
+    :param host: node of multi-host pool, HOST and PORT settings are used
+        if None
+    """
+    settings_dict = connection.settings_dict
+    pool_size = settings_dict.get('ASYNC_POOL_SIZE', 10)
+    kwargs = {
+        'charset': 'utf8',
+        'autocommit': True,
+        'minsize': 0,
+        'maxsize': pool_size,
+    }
+    if settings_dict['USER']:
+        kwargs['user'] = settings_dict['USER']
+    if settings_dict['PASSWORD']:
+        kwargs['password'] = settings_dict['PASSWORD']
+    if settings_dict['HOST'].startswith('/'):
+        kwargs['unix_socket'] = settings_dict['HOST']
+    elif settings_dict['HOST']:
+        kwargs['host'] = settings_dict['HOST']
+    if settings_dict['PORT']:
+        kwargs['port'] = int(settings_dict['PORT'])
+    if host is not None:
+        kwargs.pop('unix_socket', None)
+        kwargs['host'], kwargs['port'] = host.host, host.port
+    # database name is not passed to server because manticore does not
+    # support multiple databases, see ManticoreOperations.quote_name
+    return kwargs
+
+
+async def get_pool(connection, host: Optional[Host] = None):
+    """ Returns connection pool to database or node for current event loop."""
+    if aiomysql is None:
+        raise ImproperlyConfigured(
+            "aiomysql is required for async queries to manticore")
+    loop = asyncio.get_running_loop()
+    pools = _pools.setdefault(loop, {})
+    key = (connection.alias, None, None)
+    if host is not None:
+        key = (connection.alias, host.host, host.port)
+    pool = pools.get(key)
+    if pool is None:
+        # storing future prevents concurrent pool creation
+        pool = asyncio.ensure_future(
+            aiomysql.create_pool(**get_pool_params(connection, host)))
+        pools[key] = pool
+    return await pool
+
+
+async def close_pools():
+    """ Closes all connection pools created in current event loop."""
+    pools = _pools.pop(asyncio.get_running_loop(), {})
+    for future in pools.values():
+        pool = await future
+        pool.close()
+        await pool.wait_closed()
+
+
+async def acquire(connection):
+    """
+    Acquires connection from pool of first available node.
+
+    :returns: node or None for single host, node pool and connection
+    """
+    hosts = connection.pool
+    if hosts is None:
+        pool = await get_pool(connection)
+        return None, pool, await pool.acquire()
+    error = None
+    for host in hosts.get_candidates():
+        pool = await get_pool(connection, host)
+        try:
+            conn = await pool.acquire()
+        except (aiomysql.Error, OSError) as e:
+            hosts.mark_down(host)
+            error = e
+            continue
+        hosts.checkout(host)
+        return host, pool, conn
+    raise error
+
+
+@asynccontextmanager
+async def cursor(connection):
+    """ Acquires connection from pool and opens cursor."""
+    host, pool, conn = await acquire(connection)
+    try:
+        async with conn.cursor() as c:
+            yield c
+    finally:
+        await pool.release(conn)
+        if host is not None:
+            connection.pool.checkin(host)
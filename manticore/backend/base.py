@@ -1,13 +1,24 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone as dt_timezone
+from itertools import chain
+from queue import SimpleQueue
+from typing import Dict, List, Optional, Set
 
 import django
-from django.db import ProgrammingError
+from django.db import DEFAULT_DB_ALIAS, ProgrammingError, connections
+from django.db.models.signals import post_migrate, pre_migrate
+from django.db.backends.base.base import NO_DB_ALIAS
 from django.db.backends.base.introspection import TableInfo
 from django.db.backends.mysql import base
 from django.utils import timezone
 from django.utils.functional import cached_property
 
-from manticore.backend.schema import DatabaseSchemaEditor
+from manticore.backend.pool import get_pool
+from manticore.backend.stats import LatencyTracker, query_stats
+from manticore.backend.schema import DatabaseSchemaEditor, add_to_cluster
+from manticore.models import sharding
+from manticore.models.sql.converters import batch_converter
 
 
 class TableName(str):
@@ -42,6 +53,40 @@ class DatabaseWrapper(base.DatabaseWrapper):
         self.introspection = ManticoreIntrospection(self)
         self.ops = ManticoreOperations(self)
         self.validation = ManticoreValidation(self)
+        # node of current connection checked out from multi-host pool
+        self.pool_host = None
+        # observed latency is used for read replica selection
+        self.execute_wrappers.append(LatencyTracker(self.alias))
+
+    @cached_property
+    def pool(self):
+        """ Connection pool for HOSTS setting or None for single host."""
+        return get_pool(self.alias, self.settings_dict,
+                        error_class=base.Database.Error)
+
+    def get_new_connection(self, conn_params):
+        """ Checks out connection from multi-host pool if configured."""
+        try:
+            if self.pool is None:
+                return super().get_new_connection(conn_params)
+
+            def connect(host, port):
+                params = {**conn_params, 'host': host, 'port': port}
+                return base.DatabaseWrapper.get_new_connection(self, params)
+
+            self.pool_host, connection = self.pool.acquire(connect)
+            return connection
+        except base.Database.Error:
+            # connection errors affect read replica selection
+            query_stats.observe(self.alias, None, error=True)
+            raise
+
+    def _close(self):
+        """ Returns connection to multi-host pool if configured."""
+        if self.pool is None or self.connection is None:
+            return super()._close()
+        host, self.pool_host = self.pool_host, None
+        self.pool.release(host, self.connection, broken=self.errors_occurred)
 
     @cached_property
     def mysql_server_info(self):
@@ -77,16 +122,91 @@ class ManticoreFeatures(base.DatabaseFeatures):
 
 class ManticoreIntrospection(base.DatabaseIntrospection):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # number of nested cached() contexts
+        self._cache_depth = 0
+        # database name -> SHOW TABLES result, reset by schema changes
+        self._table_lists: Dict[str, List[TableInfo]] = {}
+        # cluster name -> names of replicated tables
+        self._cluster_tables: Dict[str, Set[str]] = {}
+        # cached() context entered by pre_migrate signal
+        self._migrate_cache = None
+
+    @contextmanager
+    def cached(self):
+        """
+        Caches table list and cluster membership within context.
+
+        Cache is enabled for migrate command run and for schema editor
+        context, so SHOW TABLES is not queried for every model.
+        """
+        self._cache_depth += 1
+        try:
+            yield
+        finally:
+            self._cache_depth -= 1
+            if not self._cache_depth:
+                self.clear_cache()
+
+    def start_migrate_cache(self):
+        """ Enables cache until end_migrate_cache() call."""
+        if self._migrate_cache is None:
+            self._migrate_cache = self.cached()
+            self._migrate_cache.__enter__()
+
+    def end_migrate_cache(self):
+        """ Disables cache enabled by start_migrate_cache()."""
+        cache, self._migrate_cache = self._migrate_cache, None
+        if cache is not None:
+            cache.__exit__(None, None, None)
+
+    def clear_cache(self):
+        """ Drops cached table list and cluster membership."""
+        self._table_lists.clear()
+        self._cluster_tables.clear()
+
     def get_table_list(self, cursor):
+        """ Returns list of tables in current database."""
+        if not self._cache_depth:
+            return self._get_table_list(cursor)
+        db_name = self.connection.ops.db_name
+        if db_name not in self._table_lists:
+            self._table_lists[db_name] = self._get_table_list(cursor)
+        return list(self._table_lists[db_name])
+
+    def get_cluster_tables(self, cursor) -> Optional[Set[str]]:
+        """
+        Returns set of table names added to replication cluster.
+
+        :returns: prefixed table names or None if cluster does not exist.
+        """
+        cluster = self.connection.ops.cluster_name
+        tables = self._cluster_tables.get(cluster)
+        if tables is None:
+            cursor.execute("SHOW STATUS LIKE %s",
+                           [f'cluster_{cluster}_indexes'])
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            tables = {n.strip() for n in row[1].split(',') if n.strip()}
+            if self._cache_depth:
+                self._cluster_tables[cluster] = tables
+        return tables
+
+    def _get_table_list(self, cursor):
         """Return a list of table and view names in the current database."""
         # mysql uses 'SHOW FULL TABLES', not supported
         cursor.execute("SHOW TABLES")
         result = []
         db_name = self.connection.ops.db_name
         database_prefix = f'{db_name}__' if db_name else None
-        # manticore annotates real-time indices with "rt" type
+        # manticore annotates real-time indices with "rt" type; percolate
+        # and distributed tables are also flushed in tests
         table_types = {
-            'rt': 't'
+            'rt': 't',
+            'percolate': 't',
+            'distributed': 't',
         }
         for row in cursor.fetchall():
             name = row[0]
@@ -135,14 +255,20 @@ class ManticoreOperations(base.DatabaseOperations):
         # argument.
         is_table_name = getattr(name, 'is_table_name', False)
         skip_cluster = getattr(name, 'skip_cluster', False)
-        if is_table_name and self.db_name:
-            name = f'{self.db_name}__{name}'
+        if is_table_name:
+            name = self.get_table_name(name)
         if is_table_name and self.cluster_name and not skip_cluster:
             cluster = super().quote_name(self.cluster_name)
             name = super().quote_name(name)
             return f'{cluster}:{name}'
         return super().quote_name(name)
 
+    def get_table_name(self, name):
+        """ Returns unquoted table name with database name prefix."""
+        if self.db_name:
+            return f'{self.db_name}__{name}'
+        return name
+
     @staticmethod
     def mark_table_name(name):
         """
@@ -174,6 +300,7 @@ class ManticoreOperations(base.DatabaseOperations):
             return int(value.astimezone(timezone.utc).timestamp())
         return super().adapt_datetimefield_value(value)
 
+    @batch_converter('convert_datetimefield_values')
     def convert_datetimefield_value(self, value, expression, connection):
         """ Convert unix timestamp values to datetime."""
         if isinstance(value, int):
@@ -183,12 +310,28 @@ class ManticoreOperations(base.DatabaseOperations):
         return super().convert_datetimefield_value(
             value, expression, connection)
 
+    def convert_datetimefield_values(self, values, expression, connection):
+        """ Batch version of convert_datetimefield_value."""
+        if self.connection.timezone_name != 'UTC':
+            return [self.convert_datetimefield_value(v, expression, connection)
+                    for v in values]
+        # unix timestamps are converted to aware datetime in single call
+        convert = self.convert_datetimefield_value
+        return [datetime.fromtimestamp(v, dt_timezone.utc)
+                if isinstance(v, int) else
+                convert(v, expression, connection) for v in values]
+
     def sql_flush(self, style, tables, *, reset_sequences=False,
                   allow_cascade=False):
         """ Implement flushing manticore database as truncating all tables."""
         if tables:
+            # distributed tables can't be truncated, their local shards are
+            # truncated instead
+            shards = {table: sharding.get_shard_tables(opts) for table, opts
+                      in sharding.get_distributed_options().items()}
             sql = []
-            for table in tables:
+            for table in chain.from_iterable(
+                    shards.get(t, [t]) for t in tables):
                 table = self.mark_table_name(table)
                 sql.append('%s %s' % (
                     style.SQL_KEYWORD('TRUNCATE RTINDEX'),
@@ -221,9 +364,17 @@ class ManticoreCreation(base.DatabaseCreation):
         # CREATE DATABASE command
         pass
 
+    def _clone_test_db(self, suffix, verbosity, keepdb=False):
+        # mysql implementation recreates database if it exists, which is
+        # not supported, see _clone_db
+        source_database_name = self.connection.settings_dict['NAME']
+        target_database_name = self.get_test_db_clone_settings(suffix)['NAME']
+        self._clone_db(source_database_name, target_database_name, keepdb)
+
     def _destroy_test_db(self, test_database_name, verbosity):
         # manticore does not support multiple databases, skipping
         # DROP DATABASE command.
+        introspection = self.connection.introspection
         # noinspection PyProtectedMember
         with self.connection._nodb_cursor() as c:
             cluster = self.connection.settings_dict.get('CLUSTER', '')
@@ -233,25 +384,146 @@ class ManticoreCreation(base.DatabaseCreation):
                     c.execute(f"DELETE CLUSTER {cluster}")
                 except ProgrammingError:
                     pass
-            # manticore does not support destroying databases, instead we
-            # drop every table with corresponding prefix
-            for table in self.connection.introspection.get_table_list(c):
-                c.execute(f"DROP TABLE {test_database_name}__{table.name}")
+            tables = introspection.get_table_list(c)
+        # manticore does not support destroying databases, instead we
+        # drop every table with corresponding prefix
+        self._execute_parallel(
+            f"DROP TABLE {test_database_name}__{table.name}"
+            for table in tables)
+
+    def _clone_db(self, source_database_name, target_database_name,
+                  keepdb=False):
+        """
+        Copies tables with source prefix to target prefix.
 
-    def _clone_db(self, source_database_name, target_database_name):
-        # copying tables with source prefix to target prefix
+        With keepdb tables kept by previous run are truncated instead of
+        being created again.
+        """
+        introspection = self.connection.introspection
+        ops = self.connection.ops
+        cluster = self.connection.settings_dict.get('CLUSTER', '')
+        members = set()
         # noinspection PyProtectedMember
         with self.connection._nodb_cursor() as c:
-            cluster = self.connection.settings_dict.get('CLUSTER', '')
+            tables = introspection.get_table_list(c)
+            c.execute("SHOW TABLES")
+            existing = {row[0] for row in c.fetchall()}
             if cluster:
-                cluster = self.connection.ops.quote_name(cluster)
-                try:
-                    c.execute(f"CREATE CLUSTER {cluster}")
-                except ProgrammingError:
-                    pass
-            for table in self.connection.introspection.get_table_list(c):
-                c.execute(f"CREATE TABLE {target_database_name}__{table.name} "
-                          f"LIKE {source_database_name}__{table.name}")
-                if cluster:
-                    c.execute(
-                        f"ALTER CLUSTER {cluster} ADD {target_database_name}__{table.name}")
+                members = introspection.get_cluster_tables(c)
+                if members is None:
+                    try:
+                        c.execute(f"CREATE CLUSTER {ops.quote_name(cluster)}")
+                    except ProgrammingError:
+                        pass
+                    members = set()
+        distributed = sharding.get_distributed_options()
+        statements = []
+        targets = []
+        # distributed tables are created after local shards
+        deferred = []
+        for table in tables:
+            source = f"{source_database_name}__{table.name}"
+            target = f"{target_database_name}__{table.name}"
+            if table.name in distributed:
+                if not keepdb or target not in existing:
+                    deferred.append((source, target))
+                continue
+            targets.append(target)
+            if not keepdb or target not in existing:
+                statements.append(f"CREATE TABLE {target} LIKE {source}")
+            elif target in members:
+                statements.append(f"TRUNCATE RTINDEX "
+                                  f"{ops.quote_name(cluster)}:{target}")
+            else:
+                statements.append(f"TRUNCATE RTINDEX {target}")
+        self._execute_parallel(statements)
+        targets = [t for t in targets if t not in members]
+        # noinspection PyProtectedMember
+        with self.connection._nodb_cursor() as c:
+            if cluster and targets:
+                # single statement for all tables instead of one per table
+                add_to_cluster(c, ops.quote_name(cluster), targets)
+            for source, target in deferred:
+                self._clone_distributed(c, source, target,
+                                        source_database_name,
+                                        target_database_name)
+
+    @staticmethod
+    def _clone_distributed(cursor, source, target, source_database_name,
+                           target_database_name):
+        """ Creates distributed table referring to cloned local shards."""
+        cursor.execute(f"SHOW CREATE TABLE {source}")
+        statement = cursor.fetchone()[1]
+        statement = statement.replace(source, target, 1).replace(
+            f"'{source_database_name}__", f"'{target_database_name}__")
+        cursor.execute(statement)
+
+    def _execute_parallel(self, statements):
+        """
+        Executes independent statements concurrently.
+
+        Every thread uses its own connection, number of threads is set
+        with DDL_WORKERS database setting.
+        """
+        statements = list(statements)
+        if not statements:
+            return
+        workers = min(self.connection.settings_dict.get('DDL_WORKERS', 8),
+                      len(statements))
+        if workers <= 1:
+            # noinspection PyProtectedMember
+            with self.connection._nodb_cursor() as c:
+                for sql in statements:
+                    c.execute(sql)
+            return
+        idle = SimpleQueue()
+        wrappers = []
+        for _ in range(workers):
+            wrapper = self.connection.__class__(
+                {**self.connection.settings_dict, 'NAME': None},
+                alias=NO_DB_ALIAS)
+            # wrappers are closed by current thread
+            wrapper.inc_thread_sharing()
+            wrappers.append(wrapper)
+            idle.put(wrapper)
+
+        def execute(sql):
+            conn = idle.get()
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(sql)
+            finally:
+                idle.put(conn)
+
+        try:
+            with ThreadPoolExecutor(workers) as executor:
+                # consuming results to raise first error
+                list(executor.map(execute, statements))
+        finally:
+            for wrapper in wrappers:
+                wrapper.close()
+                wrapper.dec_thread_sharing()
+
+
+# noinspection PyUnusedLocal
+def start_migrate_cache(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    """ Caches introspection of manticore database for migrate run."""
+    introspection = connections[using].introspection
+    if isinstance(introspection, ManticoreIntrospection):
+        introspection.start_migrate_cache()
+
+
+# noinspection PyUnusedLocal
+def end_migrate_cache(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    """ Drops introspection cache after migrate run."""
+    introspection = connections[using].introspection
+    if isinstance(introspection, ManticoreIntrospection):
+        introspection.end_migrate_cache()
+
+
+# MigrationRecorder and soft-applied migrations detection query table list
+# outside of schema editor, so cache spans whole migrate command
+pre_migrate.connect(start_migrate_cache,
+                    dispatch_uid='manticore_start_migrate_cache')
+post_migrate.connect(end_migrate_cache,
+                     dispatch_uid='manticore_end_migrate_cache')
@@ -1,7 +1,11 @@
+from functools import partial
+
 from django.db.backends.mysql import compiler
 from django.db.models import sql, lookups
+from django.db.models.sql.constants import CURSOR
 
-from manticore.models import RTField, JSONField
+from manticore.models import RTField, JSONField, sharding
+from manticore.models.sql.cache import invalidate
 from manticore.models.sql.compiler import SphinxQLCompiler
 
 
@@ -10,20 +14,128 @@ class SQLCompiler(SphinxQLCompiler):
     pass
 
 
-class SQLInsertCompiler(compiler.SQLInsertCompiler, SphinxQLCompiler):
+class WriteCompilerMixin:
+    """ Invalidates cached search results after index modification."""
+
+    def execute_sql(self, *args, **kwargs):
+        result = super().execute_sql(*args, **kwargs)
+        # noinspection PyUnresolvedReferences
+        invalidate(self.connection.ops.db_name,
+                   self.query.get_meta().db_table)
+        return result
+
+
+class ShardCursor:
+    """ Total row count of statements executed on local shards."""
+
+    def __init__(self, rowcount):
+        self.rowcount = rowcount
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class ShardingMixin:
+    """ Executes writes to distributed index on its local shards."""
+    # local shard table name used instead of distributed table name
+    shard_table = None
+
+    def quote_name_unless_alias(self, name):
+        # noinspection PyUnresolvedReferences
+        if (self.shard_table is not None and
+                name == self.query.get_meta().db_table):
+            ops = self.connection.ops
+            return ops.quote_name(ops.mark_table_name(self.shard_table))
+        # noinspection PyUnresolvedReferences
+        return super().quote_name_unless_alias(name)
+
+    def execute_shards(self, execute):
+        """
+        Calls execute for local shards affected by query.
+
+        Queries filtering by shard key values are executed only on shards
+        containing these values, other ones are executed on every shard.
+        """
+        # noinspection PyUnresolvedReferences
+        opts = self.query.get_meta()
+        results = []
+        for shard in sharding.get_shard_tables(opts, self.__get_shard_keys()):
+            self.shard_table = shard
+            try:
+                results.append(execute())
+            finally:
+                self.shard_table = None
+        return results
+
+    def __get_shard_keys(self):
+        """
+        :returns: shard key values from WHERE clause like "WHERE id IN (...)"
+            or None
+        """
+        # noinspection PyUnresolvedReferences
+        where = self.query.where
+        if len(where.children) != 1 or where.negated:
+            return None
+        node = where.children[0]
+        target = getattr(getattr(node, 'lhs', None), 'target', None)
+        # noinspection PyUnresolvedReferences
+        if target != sharding.get_shard_key_field(self.query.get_meta()):
+            return None
+        if node.lookup_name == 'exact':
+            keys = [node.rhs]
+        elif node.lookup_name == 'in':
+            keys = list(node.rhs)
+        else:
+            return None
+        if not all(isinstance(key, int) for key in keys):
+            return None
+        return keys
+
+
+class SQLInsertCompiler(WriteCompilerMixin, compiler.SQLInsertCompiler,
+                        SphinxQLCompiler):
 
-    def execute_sql(self, returning_fields=None):
+    def as_sql(self):
         """
         Marks table name for database name prefix addition.
+
+        Documents of distributed index are inserted to local shards chosen
+        by shard key value.
         """
         # noinspection PyProtectedMember
         opts = self.query.model._meta
         # marking db_table attribute to add database name prefix in quote_name
         opts.db_table = self.connection.ops.mark_table_name(opts.db_table)
-        return super().execute_sql(returning_fields)
-
-
-class SQLUpdateCompiler(compiler.SQLUpdateCompiler, SphinxQLCompiler):
+        if not sharding.is_distributed(opts):
+            return super().as_sql()
+        ops = self.connection.ops
+        table = ops.quote_name(opts.db_table)
+        objs = self.query.objs
+        result = []
+        try:
+            for shard, shard_objs in sharding.group_by_shard(
+                    opts, objs).items():
+                self.query.objs = shard_objs
+                shard = ops.quote_name(ops.mark_table_name(shard))
+                for statement, params in super().as_sql():
+                    result.append((statement.replace(table, shard, 1), params))
+        finally:
+            self.query.objs = objs
+        return result
+
+
+class SQLUpdateCompiler(ShardingMixin, WriteCompilerMixin,
+                        compiler.SQLUpdateCompiler, SphinxQLCompiler):
+
+    def execute_sql(self, result_type):
+        """ Updates every affected local shard of distributed index."""
+        if not sharding.is_distributed(self.query.get_meta()):
+            return super().execute_sql(result_type)
+        return sum(self.execute_shards(
+            partial(super().execute_sql, result_type)))
 
     def as_sql(self):
         """
@@ -41,6 +153,17 @@ class SQLUpdateCompiler(compiler.SQLUpdateCompiler, SphinxQLCompiler):
 
         return super().as_sql()
 
+    def _compile_in(self, node: lookups.In):
+        """
+        Formats "id IN values" expression for primary key lookups.
+        """
+        # UPDATE supports WHERE id IN (values_list) which is used in bulk
+        # updates.
+        target = getattr(node.lhs, 'target', None)
+        if target is not None and target.primary_key:
+            return node.as_sql(self, self.connection)
+        return super()._compile_in(node)
+
     def __get_primary_key_value(self):
         """
         :returns: pk value from WHERE clause which looks like "WHERE id = %s"
@@ -95,7 +218,22 @@ class SQLUpdateCompiler(compiler.SQLUpdateCompiler, SphinxQLCompiler):
         return False
 
 
-class SQLDeleteCompiler(compiler.SQLDeleteCompiler, SphinxQLCompiler):
+class SQLDeleteCompiler(ShardingMixin, WriteCompilerMixin,
+                        compiler.SQLDeleteCompiler, SphinxQLCompiler):
+
+    def execute_sql(self, *args, **kwargs):
+        """ Deletes from every affected local shard of distributed index."""
+        if not sharding.is_distributed(self.query.get_meta()):
+            return super().execute_sql(*args, **kwargs)
+        rowcount = 0
+        # DeleteQuery reads row count from returned cursor
+        for cursor in self.execute_shards(
+                partial(super().execute_sql, CURSOR)):
+            if cursor:
+                with cursor:
+                    rowcount += cursor.rowcount
+        return ShardCursor(rowcount)
+
     def _compile_in(self, node: lookups.In):
         """
         Formats "a IN values" expression instead of widely used in manticore
@@ -110,6 +248,6 @@ class SQLDeleteCompiler(compiler.SQLDeleteCompiler, SphinxQLCompiler):
         query.base_table = self.connection.ops.mark_table_name(query.base_table)
         if len(query.where.children) == 0:
             # unconditional delete is not supported, using truncate.
-            table_name = self.connection.ops.quote_name(query.base_table)
+            table_name = self.quote_name_unless_alias(query.base_table)
             return f"TRUNCATE RTINDEX {table_name}", ()
         return super()._as_sql(query)
@@ -0,0 +1,196 @@
+"""
+Per-process pool of connections to replicated manticore nodes.
+"""
+import os
+import time
+from collections import deque
+from itertools import count
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+ROUND_ROBIN = 'round_robin'
+LEAST_OUTSTANDING = 'least_outstanding'
+
+
+class Host:
+    """ Manticore node state."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        # number of connections checked out from pool
+        self.outstanding = 0
+        # subsequent connection failures
+        self.failures = 0
+        # monotonic time until which host is considered down
+        self.down_until = 0.0
+        # idle connections with release time
+        self.idle = deque()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}: {self.host}:{self.port}'
+
+    @property
+    def is_down(self):
+        return self.down_until > time.monotonic()
+
+
+def parse_hosts(hosts: List[Union[str, Tuple[str, int]]],
+                default_port: int) -> List[Tuple[str, int]]:
+    """ Parses HOSTS setting items like "host:port" or (host, port)."""
+    result = []
+    for item in hosts:
+        if isinstance(item, str):
+            host, _, port = item.partition(':')
+            item = (host, int(port or default_port))
+        result.append(tuple(item))
+    return result
+
+
+class ConnectionPool:
+    """
+    Pool of connections to a set of nodes replicating same tables.
+
+    Nodes are chosen round-robin or by least number of outstanding
+    connections; nodes failing to connect are marked down with exponential
+    backoff; idle connections are pinged before reuse.
+    """
+
+    def __init__(self, hosts: List[Tuple[str, int]], *,
+                 strategy: str = ROUND_ROBIN,
+                 max_idle: int = 10,
+                 health_check_interval: float = 30.0,
+                 backoff: float = 1.0,
+                 max_backoff: float = 60.0,
+                 error_class=Exception):
+        if strategy not in (ROUND_ROBIN, LEAST_OUTSTANDING):
+            raise ValueError(f"Unknown pool strategy: {strategy}")
+        self.hosts = [Host(host, port) for host, port in hosts]
+        self.strategy = strategy
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.error_class = error_class
+        self._counter = count()
+        self._lock = Lock()
+
+    def acquire(self, connect: Callable[[str, int], object]):
+        """
+        Checks out connection from pool or creates new one.
+
+        :param connect: callable creating new connection to host and port
+        :returns: host and connection
+        """
+        error = None
+        for host in self.get_candidates():
+            conn = self._pop_idle(host)
+            if conn is None:
+                try:
+                    conn = connect(host.host, host.port)
+                except self.error_class as e:
+                    self.mark_down(host)
+                    error = e
+                    continue
+            self.checkout(host)
+            return host, conn
+        raise error
+
+    def checkout(self, host: Host):
+        """ Counts connection to host as outstanding and host as healthy."""
+        with self._lock:
+            host.outstanding += 1
+            host.failures = 0
+            host.down_until = 0.0
+
+    def checkin(self, host: Host):
+        """ Counts connection to host not managed by pool as returned."""
+        with self._lock:
+            host.outstanding -= 1
+
+    def release(self, host: Host, conn, broken=False):
+        """ Returns connection to pool or closes it."""
+        with self._lock:
+            host.outstanding -= 1
+            if not broken and len(host.idle) < self.max_idle:
+                host.idle.append((conn, time.monotonic()))
+                return
+        self._close(conn)
+
+    def mark_down(self, host: Host):
+        """ Excludes host from rotation with exponential backoff."""
+        with self._lock:
+            delay = min(self.backoff * 2 ** host.failures, self.max_backoff)
+            host.failures += 1
+            host.down_until = time.monotonic() + delay
+            idle, host.idle = host.idle, deque()
+        for conn, _ in idle:
+            self._close(conn)
+
+    def close(self):
+        """ Closes all idle connections."""
+        for host in self.hosts:
+            with self._lock:
+                idle, host.idle = host.idle, deque()
+            for conn, _ in idle:
+                self._close(conn)
+
+    def get_candidates(self) -> List[Host]:
+        """ Returns hosts in order of preference, hosts marked down last."""
+        with self._lock:
+            shift = next(self._counter) % len(self.hosts)
+            hosts = self.hosts[shift:] + self.hosts[:shift]
+            if self.strategy == LEAST_OUTSTANDING:
+                # sort is stable, rotation is used to break ties
+                hosts.sort(key=lambda h: h.outstanding)
+            up = [h for h in hosts if not h.is_down]
+            # if all nodes are down, try them in order of recovery
+            down = sorted((h for h in hosts if h.is_down),
+                          key=lambda h: h.down_until)
+            return up + down
+
+    def _pop_idle(self, host: Host):
+        """ Returns healthy idle connection for host or None."""
+        while True:
+            with self._lock:
+                if not host.idle:
+                    return None
+                conn, released = host.idle.pop()
+            if time.monotonic() - released < self.health_check_interval:
+                return conn
+            try:
+                conn.ping()
+            except self.error_class:
+                self._close(conn)
+                continue
+            return conn
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except self.error_class:
+            pass
+
+
+# (process id, database alias) -> connection pool
+_pools: Dict[Tuple[int, str], ConnectionPool] = {}
+_pools_lock = Lock()
+
+
+def get_pool(alias: str, settings_dict: dict,
+             error_class=Exception) -> Optional[ConnectionPool]:
+    """ Returns per-process pool for database alias if HOSTS is set."""
+    hosts = settings_dict.get('HOSTS')
+    if not hosts:
+        return None
+    key = (os.getpid(), alias)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            options = {k.lower(): v
+                       for k, v in settings_dict.get('POOL', {}).items()}
+            default_port = int(settings_dict.get('PORT') or 9306)
+            pool = ConnectionPool(parse_hosts(hosts, default_port),
+                                  error_class=error_class, **options)
+            _pools[key] = pool
+        return pool
@@ -1,13 +1,86 @@
+import json
+import logging
+import os
+import tempfile
+import time
+
 from django.db import ProgrammingError
 from django.db.backends.mysql import schema
 from django.db.models.fields import NOT_PROVIDED
 from django.db.models.options import Options
 
-from manticore.models import fields, base
+from manticore.models import fields, base, sharding
+
+logger = logging.getLogger(__name__)
+
+# SQL literals of values which new attribute column has for existing rows
+EMPTY_VALUES = {
+    'BooleanField': '0',
+    'IntegerField': '0',
+    'BigIntegerField': '0',
+    'SmallIntegerField': '0',
+    'PositiveIntegerField': '0',
+    'PositiveBigIntegerField': '0',
+    'PositiveSmallIntegerField': '0',
+    'FloatField': '0',
+    'DateTimeField': '0',
+    'CharField': "''",
+    'TextField': "''",
+}
+
+# statements changing table list or cluster membership
+SCHEMA_CHANGES = ('CREATE TABLE', 'DROP TABLE', 'ALTER TABLE',
+                  'ALTER CLUSTER')
+
+
+def add_to_cluster(cursor, cluster, tables):
+    """ Adds quoted table names to replication cluster."""
+    try:
+        cursor.execute(f'ALTER CLUSTER {cluster} ADD {", ".join(tables)}')
+    except ProgrammingError:
+        if len(tables) == 1:
+            raise
+        # manticore versions without multiple tables support in ALTER CLUSTER
+        for table in tables:
+            cursor.execute(f'ALTER CLUSTER {cluster} ADD {table}')
 
 
 class DatabaseSchemaEditor(schema.DatabaseSchemaEditor):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # tables waiting to be added to cluster, None outside of context
+        self._cluster_pending = None
+        self._cluster_wrapper = None
+        self._introspection_cache = None
+
+    def __enter__(self):
+        # Tables created in migration are added to cluster with single
+        # statement, before any other query could use cluster prefix.
+        self._cluster_pending = []
+        self._cluster_wrapper = self.connection.execute_wrapper(
+            self._flush_cluster_wrapper)
+        self._cluster_wrapper.__enter__()
+        # table list is cached for migration time
+        self._introspection_cache = self.connection.introspection.cached()
+        self._introspection_cache.__enter__()
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            super().__exit__(exc_type, exc_value, traceback)
+            if exc_type is None:
+                self._flush_cluster()
+        finally:
+            self._cluster_pending = None
+            self._introspection_cache.__exit__(None, None, None)
+            self._cluster_wrapper.__exit__(None, None, None)
+
+    def execute(self, sql, params=()):
+        super().execute(sql, params)
+        if str(sql).lstrip().upper().startswith(SCHEMA_CHANGES):
+            self.connection.introspection.clear_cache()
+
     def prepare_default(self, value):
         raise NotImplementedError()
 
@@ -28,28 +101,93 @@ class DatabaseSchemaEditor(schema.DatabaseSchemaEditor):
             if isinstance(f, fields.RTField):
                 has_rt_index = True
                 break
-        if not has_rt_index:
+        distributed = sharding.is_distributed(opts)
+        create = (self._create_distributed_model if distributed else
+                  super().create_model)
+        if not has_rt_index and not base.is_percolate(opts):
             stub = fields.IndexedField(db_column='__stub__')
             try:
                 stub.contribute_to_class(model, '_stub')
-                super().create_model(model)
+                create(model)
             finally:
                 # removing stub to prevent fetching non-stored field
                 opts.local_fields.remove(stub)
                 opts.__dict__.pop('fields', None)
         else:
-            super().create_model(model)
-        cluster = self.connection.settings_dict.get('CLUSTER', '')
-        if cluster:
-            with self.connection._nodb_cursor() as c:
-                cluster = self.connection.ops.quote_name(cluster)
-                db_table = self.connection.ops.quote_name(opts.db_table)
+            create(model)
+        if self.connection.ops.cluster_name and not distributed:
+            self._add_to_cluster(self.connection.ops.quote_name(opts.db_table))
+        opts.db_table.skip_cluster = False
+
+    def _create_distributed_model(self, model):
+        """
+        Creates local shards with model schema and distributed table
+        combining them with remote agents.
+        """
+        # noinspection PyProtectedMember
+        opts: Options = model._meta
+        ops = self.connection.ops
+        sql, params = self.table_sql(model)
+        table = self.quote_name(opts.db_table)
+        for shard in sharding.get_shard_tables(opts):
+            shard = ops.mark_table_name(shard)
+            shard.skip_cluster = True
+            shard = self.quote_name(shard)
+            self.execute(sql.replace(table, shard, 1), params or None)
+            if ops.cluster_name:
+                # distributed table can't be replicated, but local shards can
+                self._add_to_cluster(shard)
+        self.execute(*self.distributed_table_sql(model))
+
+    def delete_model(self, model):
+        """ Drops distributed table with local shards."""
+        # noinspection PyProtectedMember
+        opts: Options = model._meta
+        if not sharding.is_distributed(opts):
+            return super().delete_model(model)
+        for table in [opts.db_table, *sharding.get_shard_tables(opts)]:
+            table = self.connection.ops.mark_table_name(str(table))
+            table.skip_cluster = True
+            self.execute(f'DROP TABLE {self.quote_name(table)}')
+
+    def _add_to_cluster(self, db_table):
+        """ Adds quoted table name to cluster or to pending tables."""
+        if self.collect_sql:
+            # sqlmigrate output should not depend on cluster state
+            cluster = self.connection.ops.quote_name(
+                self.connection.ops.cluster_name)
+            self.execute(f'ALTER CLUSTER {cluster} ADD {db_table}')
+            return
+        if self._cluster_pending is None:
+            self._add_tables_to_cluster([db_table])
+        else:
+            self._cluster_pending.append(db_table)
+
+    def _flush_cluster(self):
+        """ Adds pending tables to cluster with single statement."""
+        tables, self._cluster_pending = self._cluster_pending, []
+        if tables:
+            self._add_tables_to_cluster(tables)
+
+    def _add_tables_to_cluster(self, tables):
+        ops = self.connection.ops
+        introspection = self.connection.introspection
+        with self.connection.cursor() as c:
+            cluster = ops.quote_name(ops.cluster_name)
+            if introspection.get_cluster_tables(c) is None:
                 try:
                     c.execute(f'CREATE CLUSTER {cluster}')
                 except ProgrammingError:
                     pass
-                c.execute(f'ALTER CLUSTER {cluster} ADD {db_table}')
-        opts.db_table.skip_cluster = False
+            add_to_cluster(c, cluster, tables)
+        introspection.clear_cache()
+
+    def _flush_cluster_wrapper(self, execute, sql, params, many, context):
+        """ Adds pending tables to cluster before executing queries."""
+        # creating tables and reading cluster state don't need pending tables
+        if self._cluster_pending and not sql.startswith(('CREATE', 'SHOW')):
+            self._flush_cluster()
+        return execute(sql, params, many, context)
 
     def skip_default(self, field):
         # manticore does not support defaults at all
@@ -63,10 +201,25 @@ class DatabaseSchemaEditor(schema.DatabaseSchemaEditor):
         opts: Options = model._meta
         # mark table name to set database name prefix for created tables
         opts.db_table = self.connection.ops.mark_table_name(opts.db_table)
-        # calling BaseDatabaseSchemaEditor.add_field to skip mysql
-        # implementation
-        # noinspection PyUnresolvedReferences
-        super(schema.DatabaseSchemaEditor, self).add_field(model, field)
+        checkpoint = self._get_backfill_checkpoint(model, field)
+        last_id = None
+        if not self.collect_sql:
+            # sqlmigrate output can't depend on local checkpoint files
+            last_id = self._read_backfill_checkpoint(checkpoint)
+        if last_id is not None and not self._has_column(model, field):
+            # checkpoint is left by another database or rolled back migration
+            logger.warning("Ignoring stale backfill checkpoint %s", checkpoint)
+            os.unlink(checkpoint)
+            last_id = None
+        if last_id is None:
+            # calling BaseDatabaseSchemaEditor.add_field to skip mysql
+            # implementation
+            # noinspection PyUnresolvedReferences
+            super(schema.DatabaseSchemaEditor, self).add_field(model, field)
+        else:
+            # column is already added by interrupted migration
+            logger.info("Resuming %s.%s backfill after id %s",
+                        opts.db_table, field.column, last_id)
 
         if (self.skip_default(field) and
                 field.default not in (None, NOT_PROVIDED)):
@@ -81,13 +234,96 @@ class DatabaseSchemaEditor(schema.DatabaseSchemaEditor):
                     # empty string is default by default, no update is necessary
                     return
 
-            # UPDATE needs WHERE clause
-            # noinspection SqlNoDataSourceInspection,PyProtectedMember
-            self.execute(
-                'UPDATE %(table)s SET %(column)s = %%s WHERE `id` > %%s' % {
-                    'table': self.quote_name(model._meta.db_table),
-                    'column': self.quote_name(field.column),
-                }, [effective_default, 0])
+            self._backfill(model, field, effective_default, checkpoint,
+                           last_id or 0)
+
+    def _backfill(self, model, field, value, checkpoint, last_id):
+        """
+        Sets column value for existing rows by batches of ids.
+
+        Batch size and pause between batches in seconds are set with
+        BACKFILL_BATCH_SIZE and BACKFILL_PAUSE database settings. Last
+        updated id is stored to checkpoint file, so interrupted migration
+        continues backfill instead of adding column again.
+
+        Only rows still holding empty value of numeric, timestamp and string
+        columns are updated, so values written during backfill are kept.
+        Multi-value and JSON columns can't be compared with empty value,
+        writes to them must be paused until backfill is finished.
+        """
+        # noinspection PyProtectedMember
+        table = self.quote_name(model._meta.db_table)
+        column = self.quote_name(field.column)
+        # UPDATE needs WHERE clause
+        # noinspection SqlNoDataSourceInspection
+        update = f'UPDATE {table} SET {column} = %s WHERE `id` > %s'
+        empty = EMPTY_VALUES.get(field.get_internal_type())
+        if empty is not None:
+            update = f'{update} AND {column} = {empty}'
+        if self.collect_sql:
+            # sqlmigrate output can't depend on table contents
+            self.execute(update, [value, last_id])
+            return
+        settings_dict = self.connection.settings_dict
+        batch_size = settings_dict.get('BACKFILL_BATCH_SIZE', 10000)
+        pause = settings_dict.get('BACKFILL_PAUSE', 0)
+        # noinspection SqlNoDataSourceInspection
+        select = (f'SELECT `id` FROM {table} WHERE `id` > %s '
+                  f'ORDER BY `id` ASC LIMIT %s, 1 OPTION max_matches = %s')
+        self._write_backfill_checkpoint(checkpoint, last_id)
+        updated = 0
+        while True:
+            with self.connection.cursor() as cursor:
+                cursor.execute(select, [last_id, batch_size - 1, batch_size])
+                row = cursor.fetchone()
+            if row is None:
+                # last batch is shorter than batch_size
+                self.execute(update, [value, last_id])
+                break
+            self.execute(f'{update} AND `id` <= %s', [value, last_id, row[0]])
+            last_id = row[0]
+            updated += batch_size
+            self._write_backfill_checkpoint(checkpoint, last_id)
+            logger.info("Backfilled %s rows of %s.%s, last id %s",
+                        updated, model._meta.db_table, field.column, last_id)
+            if pause:
+                time.sleep(pause)
+        os.unlink(checkpoint)
+
+    def _has_column(self, model, field):
+        """ Checks that column exists in table with DESCRIBE."""
+        ops = self.connection.ops
+        # noinspection PyProtectedMember
+        table = ops.quote_name(ops.get_table_name(model._meta.db_table))
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DESCRIBE {table}')
+            return any(row[0] == field.column for row in cursor.fetchall())
+
+    def _get_backfill_checkpoint(self, model, field):
+        settings_dict = self.connection.settings_dict
+        directory = settings_dict.get('BACKFILL_CHECKPOINT_DIR',
+                                      tempfile.gettempdir())
+        # noinspection PyProtectedMember
+        name = '-'.join(['manticore-backfill', self.connection.alias,
+                         self.connection.ops.db_name or '',
+                         model._meta.db_table, field.column])
+        return os.path.join(directory, f'{name}.json')
+
+    @staticmethod
+    def _read_backfill_checkpoint(path):
+        """ Returns last updated id of interrupted backfill or None."""
+        try:
+            with open(path) as f:
+                return json.load(f)['last_id']
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _write_backfill_checkpoint(path, last_id):
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'last_id': last_id}, f)
+        os.replace(tmp, path)
 
     def column_sql(self, model, field, include_default=False):
         if field.primary_key:
@@ -107,11 +343,19 @@ class DatabaseSchemaEditor(schema.DatabaseSchemaEditor):
         pass
 
     def table_sql(self, model):
-        sql, params = super().table_sql(model)
         # noinspection PyProtectedMember
         opts = model._meta
+        if base.is_percolate(opts):
+            sql, params = self.percolate_table_sql(model), []
+        else:
+            sql, params = super().table_sql(model)
 
         index_sql, index_params = [], []
+        index_type = getattr(opts, 'index_type', None)
+        # for distributed index table_sql describes local shards
+        if index_type and not sharding.is_distributed(opts):
+            index_sql.append('type = %s')
+            index_params.append(index_type)
         for k in base.INDEX_OPTIONS:
             try:
                 v = getattr(opts, k)
@@ -124,3 +368,35 @@ class DatabaseSchemaEditor(schema.DatabaseSchemaEditor):
             params += index_params
 
         return sql, params
+
+    def percolate_table_sql(self, model):
+        """
+        Percolate table columns describe matched documents, not stored
+        queries, so they are taken from document_fields Meta option.
+        """
+        # noinspection PyProtectedMember
+        opts = model._meta
+        columns = ', '.join(
+            f'{self.quote_name(name)} {db_type}'
+            for name, db_type in getattr(opts, 'document_fields', {}).items())
+        return f'CREATE TABLE {self.quote_name(opts.db_table)} ({columns})'
+
+    def distributed_table_sql(self, model):
+        """ Returns CREATE TABLE statement for distributed table."""
+        # noinspection PyProtectedMember
+        opts = model._meta
+        ops = self.connection.ops
+        options, params = ['type = %s'], ['distributed']
+        for shard in sharding.get_shard_tables(opts):
+            options.append('local = %s')
+            params.append(ops.get_table_name(shard))
+        for agent in getattr(opts, 'agents', ()):
+            options.append('agent = %s')
+            params.append(agent)
+        for k in ('agent_connect_timeout', 'agent_query_timeout'):
+            v = getattr(opts, k, None)
+            if v is not None:
+                options.append(f'{k} = %s')
+                params.append(str(v))
+        table = self.quote_name(opts.db_table)
+        return f'CREATE TABLE {table} {" ".join(options)}', params
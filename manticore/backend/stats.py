@@ -0,0 +1,92 @@
+"""
+Observed query latency and error rate per database alias.
+"""
+import time
+from threading import Lock
+from typing import Dict, Optional
+
+from django.db import InterfaceError, OperationalError
+
+
+class AliasStats:
+    """ Exponentially weighted moving averages for database alias."""
+
+    def __init__(self):
+        # seconds, None until first successful query
+        self.latency: Optional[float] = None
+        # share of failed queries, 0..1
+        self.error_rate = 0.0
+        self.queries = 0
+
+
+class QueryStats:
+    """ Registry of query statistics shared by all connections in process."""
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self._stats: Dict[str, AliasStats] = {}
+        self._lock = Lock()
+
+    def observe(self, alias: str, duration: Optional[float], error=False):
+        """
+        Updates moving averages for alias.
+
+        :param alias: database alias
+        :param duration: query duration in seconds, None if unknown
+        :param error: query failed
+        """
+        alpha = self.alpha
+        with self._lock:
+            stats = self._stats.setdefault(alias, AliasStats())
+            stats.queries += 1
+            stats.error_rate += alpha * (float(error) - stats.error_rate)
+            if duration is None or error:
+                return
+            if stats.latency is None:
+                stats.latency = duration
+            else:
+                stats.latency += alpha * (duration - stats.latency)
+
+    def get(self, alias: str) -> AliasStats:
+        with self._lock:
+            return self._stats.get(alias) or AliasStats()
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+query_stats = QueryStats()
+
+
+def is_select(sql: str) -> bool:
+    """ Checks whether statement is a search query."""
+    return sql.lstrip()[:6].upper() == 'SELECT'
+
+
+class LatencyTracker:
+    """
+    Execute wrapper collecting query statistics for connection.
+
+    Only connection failures are counted as errors, latency is measured for
+    SELECT queries so that slow writes and DDL don't affect read routing.
+    """
+
+    def __init__(self, alias: str, stats: QueryStats = query_stats):
+        self.alias = alias
+        self.stats = stats
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.monotonic()
+        try:
+            result = execute(sql, params, many, context)
+        except (OperationalError, InterfaceError):
+            self.stats.observe(self.alias, None, error=True)
+            raise
+        except Exception:
+            # query errors don't say anything about server health
+            self.stats.observe(self.alias, None)
+            raise
+        duration = time.monotonic() - start if is_select(sql) else None
+        self.stats.observe(self.alias, duration)
+        return result
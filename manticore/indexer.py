@@ -0,0 +1,221 @@
+"""
+Write-behind indexer coalescing search index updates.
+"""
+import logging
+import time
+from threading import Event, Lock, Thread
+from typing import Dict, Optional, Type
+
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+from manticore.models import SearchIndex
+
+logger = logging.getLogger(__name__)
+
+
+class Batch:
+    """ Commit hook enqueueing operations made in transaction."""
+
+    def __init__(self, indexer: "WriteBehindIndexer"):
+        self.indexer = indexer
+        # (index model, pk) -> document to replace or None to delete
+        self.operations = {}
+
+    def __call__(self):
+        # noinspection PyProtectedMember
+        self.indexer._enqueue(self.operations)
+
+
+class WriteBehindIndexer:
+    """
+    Collects pending index updates and writes them by batches.
+
+    Operations are enqueued after commit of primary database transaction,
+    only the last operation per primary key is kept. Pending operations are
+    flushed as multi-row REPLACE and DELETE statements after commit or, if
+    background thread is started, every interval seconds or when max_items
+    is reached.
+    """
+
+    def __init__(self, interval: float = 0.1, max_items: int = 1000,
+                 database: Optional[str] = None):
+        """
+        :param interval: background flush interval in seconds
+        :param max_items: number of pending operations waking background
+            thread
+        :param database: manticore database alias, routed by default
+        """
+        self.interval = interval
+        self.max_items = max_items
+        self.database = database
+        # index model -> pk -> document to replace or None to delete
+        self._pending: Dict[Type[SearchIndex], Dict] = {}
+        self._pending_count = 0
+        # monotonic time of oldest pending operation
+        self._pending_since: Optional[float] = None
+        self._lock = Lock()
+        # flushes are serialized to keep operations order
+        self._flush_lock = Lock()
+        self._thread: Optional[Thread] = None
+        self._wakeup = Event()
+        self._stopped = Event()
+        self.flushes = 0
+        self.items_flushed = 0
+        self.errors = 0
+        # seconds between oldest operation enqueue and flush completion
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def upsert(self, obj: SearchIndex, using: str = DEFAULT_DB_ALIAS):
+        """
+        Schedules document REPLACE.
+
+        :param obj: search index document with primary key set
+        :param using: primary database alias which transaction commit
+            enqueues operation
+        """
+        if obj.pk is None:
+            raise ValueError("Indexed document must have primary key")
+        self._on_commit(type(obj), obj.pk, obj, using)
+
+    def delete(self, model: Type[SearchIndex], pk,
+               using: str = DEFAULT_DB_ALIAS):
+        """ Schedules document deletion by primary key."""
+        self._on_commit(model, pk, None, using)
+
+    @property
+    def lag(self) -> float:
+        """ Age of oldest pending operation in seconds."""
+        since = self._pending_since
+        return 0.0 if since is None else time.monotonic() - since
+
+    def stats(self) -> dict:
+        """ Returns queue and flush counters for monitoring."""
+        return {
+            'pending': self._pending_count,
+            'lag': self.lag,
+            'flushes': self.flushes,
+            'items_flushed': self.items_flushed,
+            'errors': self.errors,
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag,
+        }
+
+    def start(self):
+        """ Starts background flush thread."""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = Thread(target=self._run, name='manticore-indexer',
+                              daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stops background thread and flushes pending operations."""
+        if self._thread is not None:
+            self._stopped.set()
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def flush(self) -> int:
+        """
+        Writes pending operations to search index.
+
+        :returns: number of written operations
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                since, self._pending_since = self._pending_since, None
+                self._pending_count = 0
+            if not pending:
+                return 0
+            count = 0
+            try:
+                for model, operations in list(pending.items()):
+                    self._write(model, operations)
+                    count += len(operations)
+                    del pending[model]
+            except Exception:
+                self.errors += 1
+                self._requeue(pending, since)
+                raise
+            lag = time.monotonic() - since
+            self.flushes += 1
+            self.items_flushed += count
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            return count
+
+    def _write(self, model, operations):
+        manager = model.objects
+        if self.database:
+            manager = manager.using(self.database)
+        replaced = [obj for obj in operations.values() if obj is not None]
+        deleted = [pk for pk, obj in operations.items() if obj is None]
+        if replaced:
+            manager.bulk_replace(replaced)
+        if deleted:
+            manager.filter(pk__in=deleted).delete()
+
+    def _requeue(self, pending, since):
+        """ Returns operations of failed flush unless they are overwritten."""
+        with self._lock:
+            for model, operations in pending.items():
+                queue = self._pending.setdefault(model, {})
+                for pk, obj in operations.items():
+                    if pk not in queue:
+                        queue[pk] = obj
+                        self._pending_count += 1
+            if self._pending_since is None or since < self._pending_since:
+                self._pending_since = since
+
+    def _on_commit(self, model, pk, obj, using):
+        connection = connections[using]
+        if not connection.in_atomic_block:
+            self._enqueue({(model, pk): obj})
+            return
+        # Operations are collected by commit hook registered for current
+        # savepoint, so they are discarded on rollback with the hook. Hook is
+        # reused only if it is the last one, otherwise it would be flushed
+        # before newer operations of released nested savepoints.
+        hooks = connection.run_on_commit
+        batch = hooks[-1][1] if hooks else None
+        if not (isinstance(batch, Batch) and batch.indexer is self and
+                hooks[-1][0] == set(connection.savepoint_ids)):
+            batch = Batch(self)
+            transaction.on_commit(batch, using=using)
+        batch.operations[(model, pk)] = obj
+
+    def _enqueue(self, operations):
+        with self._lock:
+            for (model, pk), obj in operations.items():
+                queue = self._pending.setdefault(model, {})
+                if pk not in queue:
+                    self._pending_count += 1
+                queue[pk] = obj
+            if self._pending_since is None:
+                self._pending_since = time.monotonic()
+            full = self._pending_count >= self.max_items
+        if self._thread is None:
+            # operations are requeued by failed flush; errors must not
+            # propagate to committed transaction or upsert/delete caller
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Search index flush failed")
+        elif full:
+            self._wakeup.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Search index flush failed")
+        # connections opened by background thread
+        connections.close_all()
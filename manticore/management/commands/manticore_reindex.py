@@ -0,0 +1,142 @@
+import json
+import multiprocessing
+import os
+import time
+
+import django
+from django.apps import apps
+from django.core.management import BaseCommand, CommandError
+from django.db import connections, router
+
+from manticore.models import SearchIndex
+
+
+def index_range(task):
+    """
+    Copies source objects with primary keys in (start, end] range to index.
+
+    Executed in worker processes, so task contains only picklable values.
+    """
+    label, using, start, end = task
+    model = apps.get_model(label)
+    qs = model.get_source_queryset().filter(pk__lte=end)
+    if start is not None:
+        qs = qs.filter(pk__gt=start)
+    objs = [model.from_source(obj) for obj in qs.order_by('pk').iterator()]
+    # range size is limited by --batch-size, packet size by bulk_replace
+    model.objects.using(using).bulk_replace(objs, batch_size=len(objs))
+    return end, len(objs)
+
+
+def init_worker():
+    if not apps.ready:
+        # spawned processes don't inherit configured django
+        django.setup()
+
+
+class Command(BaseCommand):
+    help = "Rebuilds search index from source model."
+
+    def add_arguments(self, parser):
+        parser.add_argument('index', help="Search index as app_label.Model")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Number of objects in REPLACE query")
+        parser.add_argument('--workers', type=int, default=1,
+                            help="Number of worker processes")
+        parser.add_argument('--database',
+                            help="Manticore database alias")
+        parser.add_argument('--checkpoint',
+                            help="File to store last indexed primary key")
+        parser.add_argument('--resume', action='store_true',
+                            help="Continue from primary key in checkpoint")
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        label = options['index']
+        try:
+            model = apps.get_model(label)
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        if not issubclass(model, SearchIndex):
+            raise CommandError(f"{label} is not a search index")
+        if options['resume'] and not options['checkpoint']:
+            raise CommandError("--resume requires --checkpoint")
+        using = options['database'] or router.db_for_write(model)
+        batch_size = options['batch_size']
+        checkpoint = options['checkpoint']
+        start = None
+        if options['resume'] and os.path.exists(checkpoint):
+            start = self.read_checkpoint(checkpoint, label)
+
+        # ranges are computed before dispatching, so workers pool doesn't
+        # read source database in its task handler thread
+        ranges = [(label, using, lo, hi) for lo, hi in
+                  self.get_ranges(model, start, batch_size)]
+        workers = options['workers']
+        total = 0
+        started = time.monotonic()
+        if workers > 1:
+            # each worker opens own connections
+            connections.close_all()
+            context = multiprocessing.get_context()
+            with context.Pool(workers, initializer=init_worker) as pool:
+                # results are returned in ranges order, so checkpoint is
+                # always followed by fully indexed ranges
+                results = pool.imap(index_range, ranges)
+                total = self.process(results, label, checkpoint, started)
+        else:
+            results = map(index_range, ranges)
+            total = self.process(results, label, checkpoint, started)
+        self.stdout.write(self.style.SUCCESS(
+            f"{total} objects indexed in "
+            f"{time.monotonic() - started:.1f}s"))
+
+    @staticmethod
+    def get_ranges(model, start, batch_size):
+        """
+        Splits source queryset to primary key ranges by keyset paging.
+
+        Only last primary key of each range is fetched from source database.
+        """
+        qs = model.get_source_queryset().values_list('pk', flat=True)
+        ranges = []
+        while True:
+            page = qs if start is None else qs.filter(pk__gt=start)
+            end = list(page.order_by('pk')[batch_size - 1:batch_size])
+            if not end:
+                # last range is shorter than batch size
+                end = list(page.order_by('-pk')[:1])
+                if end:
+                    ranges.append((start, end[0]))
+                return ranges
+            ranges.append((start, end[0]))
+            start = end[0]
+
+    def process(self, results, label, checkpoint, started):
+        """ Reports progress and saves checkpoint for each indexed range."""
+        total = 0
+        for end, count in results:
+            total += count
+            if checkpoint:
+                self.write_checkpoint(checkpoint, label, end)
+            if self.verbosity > 0:
+                rate = total / max(time.monotonic() - started, 1e-6)
+                self.stdout.write(
+                    f"{total} objects indexed, {rate:.0f} objects/s, "
+                    f"last pk {end}")
+        return total
+
+    @staticmethod
+    def read_checkpoint(path, label):
+        with open(path) as f:
+            data = json.load(f)
+        if data['index'] != label:
+            raise CommandError(f"Checkpoint is created for {data['index']}")
+        return data['last_pk']
+
+    @staticmethod
+    def write_checkpoint(path, label, pk):
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'index': label, 'last_pk': pk}, f)
+        os.replace(tmp, path)
@@ -1,6 +1,8 @@
-from .base import SearchIndex
-from .manager import SearchManager
-from .query import SearchQuerySet
+from .base import PercolateIndex, SearchIndex
+from .manager import PercolateManager, SearchManager
+from .query import PercolateQuerySet, SearchPage, SearchQuerySet
 from .fields import *
 
-__all__ = fields.__all__ + ['SearchIndex', 'SearchManager', 'SearchQuerySet']
+__all__ = fields.__all__ + ['PercolateIndex', 'PercolateManager',
+                            'PercolateQuerySet', 'SearchIndex',
+                            'SearchManager', 'SearchPage', 'SearchQuerySet']
@@ -1,9 +1,11 @@
+from django.db import models
 from django.db.models import base, options
 
-from manticore.models.manager import SearchManager
+from manticore.models import fields
+from manticore.models.manager import PercolateManager, SearchManager
 
 
-__all__ = ['SearchIndex']
+__all__ = ['PercolateIndex', 'SearchIndex']
 
 
 INDEX_OPTIONS = (
@@ -13,7 +15,23 @@ INDEX_OPTIONS = (
     'charset_table',
 )
 
-options.DEFAULT_NAMES += INDEX_OPTIONS
+# table type ("pq" or "distributed"), percolate document schema and
+# distributed index options, see manticore.models.sharding
+TABLE_OPTIONS = (
+    'index_type',
+    'document_fields',
+    'local_shards',
+    'agents',
+    'agent_connect_timeout',
+    'agent_query_timeout',
+    'shard_key',
+)
+
+options.DEFAULT_NAMES += INDEX_OPTIONS + TABLE_OPTIONS
+
+
+def is_percolate(opts: options.Options) -> bool:
+    return getattr(opts, 'index_type', None) == 'pq'
 
 
 class SearchIndexBase(base.ModelBase):
@@ -26,3 +44,45 @@ class SearchIndex(base.Model, metaclass=SearchIndexBase):
         abstract = True
 
     objects = SearchManager()
+
+    @classmethod
+    def get_source_queryset(cls):
+        """
+        Returns queryset of source objects for manticore_reindex command.
+        """
+        raise NotImplementedError(
+            f"{cls.__name__}.get_source_queryset() is not defined")
+
+    @classmethod
+    def from_source(cls, obj) -> "SearchIndex":
+        """
+        Maps source object to search index document.
+
+        By default primary key and fields with same names are copied.
+        """
+        # noinspection PyProtectedMember
+        kwargs = {f.attname: getattr(obj, f.attname)
+                  for f in cls._meta.concrete_fields
+                  if hasattr(obj, f.attname)}
+        kwargs['pk'] = obj.pk
+        return cls(**kwargs)
+
+
+class PercolateIndex(SearchIndex):
+    """
+    Percolate index base model (type='pq').
+
+    Rows are stored search queries, documents are matched against them with
+    `objects.percolate()`. Matched documents schema is declared with
+    `document_fields` Meta option mapping column names to manticore types;
+    Meta of subclasses must extend PercolateIndex.Meta.
+    """
+    class Meta:
+        abstract = True
+        index_type = 'pq'
+
+    query = fields.PercolateQueryField()
+    tags = models.CharField(max_length=255, default='', blank=True)
+    filters = models.CharField(max_length=255, default='', blank=True)
+
+    objects = PercolateManager()
@@ -1,10 +1,30 @@
 import json
+from array import array
 
+from django.conf import settings
 from django.db import models
+from django.db.models.query_utils import DeferredAttribute
 
-__all__ = ['BigMultiField', 'JSONField', 'MultiField', 'RTField']
+__all__ = ['BigMultiField', 'JSONField', 'MultiField', 'PercolateQueryField',
+           'RawJSON', 'RTField']
 
 from manticore.models import lookups
+from manticore.models.sql.converters import batch_converter
+from manticore.sphinxql.base import escape
+
+
+def get_json_loads():
+    """ Returns orjson.loads if enabled by MANTICORE_ORJSON setting."""
+    if getattr(settings, 'MANTICORE_ORJSON', False):
+        from orjson import loads
+        return loads
+    return json.loads
+
+
+def parse_multi_values(values):
+    """ Parses column of comma-separated MVA values with single loads call."""
+    loads = get_json_loads()
+    return loads('[[' + '],['.join([value or '' for value in values]) + ']]')
 
 
 class RTField(models.TextField):
@@ -30,49 +50,174 @@ class IndexedField(RTField):
         return 'text indexed'
 
 
+class PercolateQueryField(models.TextField):
+    """ Stored query of percolate index, accepts SphinxQL expressions."""
+
+    def get_prep_value(self, value):
+        if hasattr(value, 'as_sphinxql'):
+            sphinxql, params = value.as_sphinxql()
+            return sphinxql % tuple(map(escape, params))
+        return super().get_prep_value(value)
+
+
+class RawJSON(str):
+    """ Undecoded value of lazy JSONField."""
+
+
+class LazyJSONAttribute(DeferredAttribute):
+    """ Decodes raw JSON value on first attribute access."""
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        value = super().__get__(instance, cls)
+        if isinstance(value, RawJSON):
+            value = self.field.loads(str(value))
+            instance.__dict__[self.field.attname] = value
+        return value
+
+    def __set__(self, instance, value):
+        # data descriptor is not shadowed by value in instance __dict__
+        instance.__dict__[self.field.attname] = value
+
+
 class JSONField(models.Field):
-    """ JSON field (attr_json)."""
+    """
+    JSON field (attr_json).
+
+    With lazy=True values fetched from database are decoded on first model
+    attribute access, values() and values_list() return RawJSON strings.
+    """
+
+    def __init__(self, *args, lazy=False, dumps=None, loads=None, **kwargs):
+        """
+        :param lazy: decode JSON on first attribute access
+        :param dumps: callable encoding value to str or bytes
+        :param loads: callable decoding str value, json.loads by default or
+            orjson.loads with MANTICORE_ORJSON setting
+        """
+        self.lazy = lazy
+        self.dumps = dumps or json.dumps
+        self._loads = loads
+        self.loads = loads or get_json_loads()
+        if lazy:
+            self.descriptor_class = LazyJSONAttribute
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.lazy:
+            kwargs['lazy'] = True
+        if self.dumps is not json.dumps:
+            kwargs['dumps'] = self.dumps
+        if self._loads is not None:
+            kwargs['loads'] = self._loads
+        return name, path, args, kwargs
+
     def db_type(self, connection):
         return 'json'
 
     def get_internal_type(self):
         return "JSONField"
 
+    def pre_save(self, model_instance, add):
+        if self.attname in model_instance.__dict__:
+            # lazy value is saved as is without decoding and encoding again
+            return model_instance.__dict__[self.attname]
+        return super().pre_save(model_instance, add)
+
     def get_prep_value(self, value):
         if value is None:
             return ''
-        return json.dumps(value)
+        if isinstance(value, RawJSON):
+            # value is not decoded since fetching from database
+            return str(value)
+        value = self.dumps(value)
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        return value
 
-    # noinspection PyMethodMayBeStatic,PyUnusedLocal
+    # noinspection PyUnusedLocal
+    @batch_converter('from_db_values')
     def from_db_value(self, value, expression, connection):
         if value is None:
             return None
-        return json.loads(value)
-
-
-class MultiField(models.PositiveIntegerField):
-    """ Multi-field (attr_multi). Contains a list of uint32."""
-    def db_type(self, connection):
-        return 'multi'
-
-    def get_internal_type(self):
-        return 'MultiField'
+        if self.lazy:
+            return RawJSON(value)
+        return self.loads(value)
+
+    # noinspection PyUnusedLocal
+    def from_db_values(self, values, expression, connection):
+        """ Batch version of from_db_value used by SphinxQLCompiler."""
+        if self.lazy:
+            return [None if value is None else RawJSON(value)
+                    for value in values]
+        loads = self.loads
+        return [None if value is None else loads(value) for value in values]
+
+
+class MultiValueMixin:
+    """
+    Common conversions for multi-value attributes.
+
+    With compact=True values are returned as array.array instead of list of
+    int objects, which needs much less memory for long MVA.
+    """
+    typecode: str
+
+    def __init__(self, *args, compact=False, **kwargs):
+        self.compact = compact
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.compact:
+            kwargs['compact'] = True
+        return name, path, args, kwargs
 
     def get_prep_value(self, value):
+        if isinstance(value, array):
+            return value.tolist()
         return value
 
-    # noinspection PyMethodMayBeStatic,PyUnusedLocal
+    # noinspection PyUnusedLocal
+    @batch_converter('from_db_values')
     def from_db_value(self, value, expression, connection):
+        if self.compact:
+            if not value:
+                return array(self.typecode)
+            return array(self.typecode, map(int, value.split(',')))
         if not value:
             return []
         return list(map(int, value.split(',')))
 
+    # noinspection PyUnusedLocal
+    def from_db_values(self, values, expression, connection):
+        """ Batch version of from_db_value used by SphinxQLCompiler."""
+        rows = parse_multi_values(values)
+        if self.compact:
+            typecode = self.typecode
+            return [array(typecode, row) for row in rows]
+        return rows
+
+
+class MultiField(MultiValueMixin, models.PositiveIntegerField):
+    """ Multi-field (attr_multi). Contains a list of uint32."""
+    typecode = 'I'
+
+    def db_type(self, connection):
+        return 'multi'
+
+    def get_internal_type(self):
+        return 'MultiField'
+
 
 MultiField.register_lookup(lookups.MultiExact)
 
 
-class BigMultiField(models.BigIntegerField):
+class BigMultiField(MultiValueMixin, models.BigIntegerField):
     """ Multi-field for big integer (attr_multi64). Contains a list of int64."""
+    typecode = 'q'
 
     def db_type(self, connection):
         return 'multi64'
@@ -80,14 +225,5 @@ class BigMultiField(models.BigIntegerField):
     def get_internal_type(self):
         return 'BigMultiField'
 
-    def get_prep_value(self, value):
-        return value
-
-    # noinspection PyMethodMayBeStatic,PyUnusedLocal
-    def from_db_value(self, value, expression, connection):
-        if not value:
-            return []
-        return list(map(int, value.split(',')))
-
 
 BigMultiField.register_lookup(lookups.MultiExact)
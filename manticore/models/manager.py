@@ -1,8 +1,12 @@
 from django.db.models import manager
 
-from manticore.models.query import SearchQuerySet
+from manticore.models.query import PercolateQuerySet, SearchQuerySet
 
 
 class SearchManager(manager.BaseManager.from_queryset(SearchQuerySet)):
     """ Manager for search indices."""
     # Copies SearchQuerySet.match() method to Manager
+
+
+class PercolateManager(manager.BaseManager.from_queryset(PercolateQuerySet)):
+    """ Manager for percolate indices."""
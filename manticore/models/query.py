@@ -1,17 +1,88 @@
+import json
 import operator
+from array import array
+from collections import defaultdict
 from functools import reduce
+from itertools import islice
+from typing import List, NamedTuple
 
-from django.core.exceptions import FieldError
-from django.db.models.query import QuerySet
-from django.db.models.sql import AND
+import django
+from asgiref.sync import sync_to_async
+from django.core.exceptions import EmptyResultSet, FieldError
+from django.db import connections
+from django.db.models import AutoField, Count, IntegerField
+from django.db.models.deletion import Collector
+from django.db.models.query import (
+    BaseIterable, QuerySet, ModelIterable, MAX_GET_RESULTS)
+from django.db.models.sql import AND, DeleteQuery, InsertQuery
+from django.db.models.sql.constants import MULTI
+from django.utils import tree
+from django.utils.hashable import make_hashable
 
+from manticore.backend import aio
 from manticore.models import sql
+from manticore.models.sql.cache import invalidate
+from manticore.models.functions import Weight
+from manticore.models.sharding import is_distributed
+from manticore.models.sql.meta import SearchMeta
 from manticore.sphinxql.expressions import T, Match, F
 from manticore.sphinxql.base import SphinxQLCombinable, SphinxQLNode
-from manticore.models.fields import RTField
+from manticore.models.fields import RTField, JSONField
+
+if django.VERSION < (4, 1):
+    # conflict resolving flag forces REPLACE INTO, see insert_statement
+    REPLACE = {'ignore_conflicts': True}
+else:
+    from django.db.models.constants import OnConflict
+    REPLACE = {'on_conflict': OnConflict.IGNORE}
+
+
+# manticore default value for max_matches option
+DEFAULT_MAX_MATCHES = 1000
+
+
+class SearchPage(NamedTuple):
+    """ Page of search results with total number of matches."""
+    objects: List
+    total: int
+    # whether total is exact or a lower bound
+    exact: bool
+
+
+def is_conjunction(node) -> bool:
+    """ Checks that where clause node does not contain OR or NOT."""
+    if not isinstance(node, tree.Node):
+        return True
+    if node.connector != AND or node.negated:
+        return False
+    return all(map(is_conjunction, node.children))
+
+
+class RawRowsIterable(BaseIterable):
+    """
+    Yields fetched rows as tuples without converters and model instances.
+    """
+
+    def __iter__(self):
+        queryset = self.queryset
+        compiler = queryset.query.get_compiler(queryset.db)
+        results = compiler.execute_sql(MULTI, chunked_fetch=self.chunked_fetch,
+                                       chunk_size=self.chunk_size)
+        # filtering conditions column added by SphinxQLCompiler
+        where = (compiler.annotation_col_map or {}).get('__where__')
+        for rows in results:
+            if where is None:
+                yield from rows
+            else:
+                for row in rows:
+                    yield row[:where] + row[where + 1:]
 
 
 class SearchQuerySet(QuerySet):
+    # number of documents deleted by single query in chunked delete()
+    delete_batch_size = 1000
+    # number of documents updated by single query in bulk_update()
+    update_batch_size = 1000
 
     def __init__(self, model=None, query=None, using=None, hints=None):
         query = query or sql.SearchQuery(model)
@@ -21,7 +92,7 @@ class SearchQuerySet(QuerySet):
         """ Very large usage description here."""
         qs: SearchQuerySet = self._clone()
         expression = self._build_match_expression(*args, **kwargs)
-        qs._match_expression().add(expression)
+        qs._add_match_expression(expression)
         return qs
 
     def options(self, field_weights=None, **kwargs):
@@ -35,6 +106,555 @@ class SearchQuerySet(QuerySet):
         qs.query.options.update(kwargs)
         return qs
 
+    def with_meta(self):
+        """
+        Requests search statistics with SHOW META after search query.
+
+        Statistics are available as `meta` attribute of evaluated queryset.
+        """
+        qs: SearchQuerySet = self._clone()
+        qs.query.with_meta = True
+        return qs
+
+    @property
+    def meta(self):
+        """
+        SHOW META results for querysets with with_meta(), evaluates queryset.
+        """
+        if not self.query.with_meta:
+            return None
+        self._fetch_all()
+        return self.query.meta
+
+    def cache(self, ttl=60, backend=None):
+        """
+        Stores raw search results in Django cache.
+
+        Cached results are invalidated by any write to the index made
+        through ORM, with MANTICORE_CACHE_INVALIDATION = False setting they
+        only expire after ttl.
+
+        :param ttl: cache timeout in seconds
+        :param backend: cache alias, MANTICORE_CACHE_BACKEND setting is used
+            by default
+        """
+        qs: SearchQuerySet = self._clone()
+        qs.query.cache_ttl = ttl
+        qs.query.cache_backend = backend
+        return qs
+
+    def facet(self, field, order_by=None, limit=None, alias=None):
+        """
+        Adds FACET clause counting documents by attribute value.
+
+        Facets are computed by server in the same pass as search results and
+        are available as `facets` attribute of evaluated queryset.
+
+        :param field: attribute name
+        :param order_by: "count" or field name, optionally prefixed with "-"
+        :param limit: max number of facet values
+        :param alias: facet results key, field name by default; allows
+            multiple facets by same field
+        """
+        # noinspection PyProtectedMember
+        column = self.model._meta.get_field(field).column
+        if order_by is not None and order_by.lstrip('-') not in ('count', field):
+            raise ValueError(f'Invalid facet ordering: {order_by}')
+        name = alias or field
+        if any(facet.name == name for facet in self.query.facets):
+            raise ValueError(f'Duplicate facet name: {name}')
+        qs: SearchQuerySet = self._clone()
+        qs.query.facets.append(sql.Facet(name, column, order_by, limit))
+        return qs
+
+    @property
+    def facets(self):
+        """
+        Facet name -> list of (value, count) pairs, evaluates queryset.
+        """
+        if not self.query.facets:
+            return {}
+        self._fetch_all()
+        return self.query.facet_results
+
+    def raw_rows(self, *fields):
+        """
+        Returns queryset yielding database rows as tuples.
+
+        Model instances are not created and values are not converted, i.e.
+        timestamps are ints and JSON and MVA values are strings.
+
+        :param fields: selected fields, all fields by default
+        """
+        qs = self.values_list(*fields) if fields else self._chain()
+        qs._iterable_class = RawRowsIterable
+        return qs
+
+    def ids(self) -> array:
+        """ Returns primary keys of found documents as compact array."""
+        return array('q', (row[0] for row in self.raw_rows('pk').iterator()))
+
+    def hydrate(self, model, id_field='pk', chunk_size=1000,
+                select_related=(), prefetch_related=(), on_missing='skip'):
+        """
+        Yields objects of another model for found documents with weight.
+
+        Objects are fetched from model database by chunks of document
+        primary keys and are returned in search results order.
+
+        :param model: model to fetch objects from
+        :param id_field: model field containing document primary key
+        :param chunk_size: number of objects fetched by single query
+        :param select_related: select_related() lookups for model queryset
+        :param prefetch_related: prefetch_related() lookups for model
+            queryset
+        :param on_missing: what to do with documents missing in model
+            database: "skip", "none" to yield None instead of object or
+            "raise" to raise model.DoesNotExist
+        :returns: iterator of (object, weight) pairs
+        """
+        if on_missing not in ('skip', 'none', 'raise'):
+            raise ValueError(f"Invalid on_missing value: {on_missing}")
+        # noinspection PyProtectedMember
+        opts = model._meta
+        field = opts.pk if id_field == 'pk' else opts.get_field(id_field)
+        queryset = model._default_manager.all()
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        hits = self.annotate(
+            search_weight=Weight(output_field=IntegerField())
+        ).raw_rows('pk', 'search_weight')
+        return self._hydrate(hits, queryset, id_field, field.attname,
+                             chunk_size, on_missing)
+
+    @staticmethod
+    def _hydrate(hits, queryset, id_field, attname, chunk_size, on_missing):
+        hits = hits.iterator()
+        while True:
+            chunk = list(islice(hits, chunk_size))
+            if not chunk:
+                break
+            lookup = {f'{id_field}__in': [pk for pk, _ in chunk]}
+            objs = {getattr(obj, attname): obj
+                    for obj in queryset.filter(**lookup)}
+            for pk, weight in chunk:
+                obj = objs.get(pk)
+                if obj is None:
+                    if on_missing == 'skip':
+                        continue
+                    if on_missing == 'raise':
+                        raise queryset.model.DoesNotExist(
+                            f"{queryset.model.__name__} with {id_field}={pk} "
+                            f"does not exist")
+                yield obj, weight
+
+    def page(self, offset, limit) -> SearchPage:
+        """
+        Returns page of search results with total_found from SHOW META.
+
+        Total number of matches is read in the same batch as search results,
+        so separate COUNT(*) query is not needed.
+        """
+        if offset < 0 or limit <= 0:
+            raise ValueError("Invalid offset or limit")
+        qs = self.with_meta()
+        max_matches = offset + limit
+        if max_matches > qs.query.options.get('max_matches',
+                                              DEFAULT_MAX_MATCHES):
+            # manticore does not return matches past max_matches
+            qs = qs.options(max_matches=max_matches)
+        qs = qs[offset:offset + limit]
+        objects = list(qs)
+        meta = qs.meta
+        return SearchPage(objects, meta.total_found, meta.exact)
+
+    def stream(self, batch_size=1000):
+        """
+        Iterates over search results with keyset pagination.
+
+        Results are fetched page by page ordered by primary key, each page is
+        requested with `WHERE id > last_id ORDER BY id ASC LIMIT batch_size`
+        so memory usage does not depend on index size.
+        """
+        if batch_size <= 0:
+            raise ValueError("batch_size must be positive")
+        if self.query.is_sliced:
+            raise TypeError("Cannot stream a query once a slice has been taken.")
+        if self._fields is not None:
+            raise TypeError("stream() is not supported for values() querysets")
+        pk = self.model._meta.pk.name
+        qs = self.order_by(pk).options(max_matches=batch_size)
+        page = qs[:batch_size]
+        while True:
+            objs = list(page)
+            yield from objs
+            if len(objs) < batch_size:
+                break
+            page = qs.filter(**{f'{pk}__gt': objs[-1].pk})[:batch_size]
+
+    def delete(self):
+        """
+        Deletes found documents.
+
+        Conjunction of attribute filters and MATCH is compiled to single
+        DELETE ... WHERE statement. Other filters are resolved to primary
+        keys which are deleted by chunks. If index has delete signal
+        receivers, documents are deleted with Collector chunk by chunk.
+        """
+        if (self.query.is_sliced or self._fields is not None or
+                not self.query.where):
+            # unconditional delete is performed with TRUNCATE, see
+            # SQLDeleteCompiler
+            return super().delete()
+        if not Collector(using=self.db).can_fast_delete(self):
+            return self._delete_collected()
+        if is_conjunction(self.query.where):
+            deleted = self._raw_delete_query(self)
+        else:
+            deleted = self._delete_by_ids()
+        self._result_cache = None
+        # noinspection PyProtectedMember
+        return deleted, {self.model._meta.label: deleted}
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    @staticmethod
+    def _raw_delete_query(qs):
+        qs = qs._chain()
+        qs.query.clear_ordering(True)
+        return qs._raw_delete(qs.db)
+
+    def _delete_by_ids(self):
+        """ Deletes found documents by chunks of primary keys."""
+        batch_size = self.delete_batch_size
+        qs = self.order_by('pk').options(max_matches=batch_size)
+        manager = self.model._base_manager.db_manager(self.db)
+        deleted = 0
+        last = None
+        while True:
+            page = qs if last is None else qs.filter(pk__gt=last)
+            ids = page[:batch_size].ids()
+            if not ids:
+                break
+            deleted += self._raw_delete_query(
+                manager.filter(pk__in=ids.tolist()))
+            last = ids[-1]
+        return deleted
+
+    def _delete_collected(self):
+        """ Deletes documents with signals sending by chunks."""
+        deleted = 0
+        counter = defaultdict(int)
+        objs = self.stream(self.delete_batch_size)
+        while True:
+            chunk = list(islice(objs, self.delete_batch_size))
+            if not chunk:
+                break
+            collector = Collector(using=self.db)
+            collector.collect(chunk)
+            count, rows_count = collector.delete()
+            deleted += count
+            for label, value in rows_count.items():
+                counter[label] += value
+        self._result_cache = None
+        return deleted, dict(counter)
+
+    def bulk_replace(self, objs, batch_size=1000,
+                     max_bytes=8 * 1024 * 1024):
+        """
+        Inserts or replaces objects with multi-row REPLACE statements.
+
+        REPLACE rewrites whole document, so objects must have primary key
+        set and all fields loaded. Statements are split by row count and by
+        estimated size to fit into manticore max_packet_size.
+        """
+        objs = list(objs)
+        if not objs:
+            return 0
+        for obj in objs:
+            if obj.pk is None:
+                raise ValueError("bulk_replace() requires primary key values")
+            if obj.get_deferred_fields():
+                raise ValueError("bulk_replace() can't be used with deferred "
+                                 "fields")
+        self._for_write = True
+        # noinspection PyProtectedMember
+        fields = self.model._meta.concrete_fields
+        for batch in self._replace_batches(objs, fields, batch_size, max_bytes):
+            self._insert(batch, fields=fields, using=self.db, **REPLACE)
+        return len(objs)
+
+    bulk_replace.alters_data = True
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        """
+        Updates attributes of given objects grouped by new value.
+
+        For each field objects are grouped by target value and a single
+        `UPDATE ... SET col = %s WHERE id IN (...)` is performed for each
+        distinct value, because manticore does not support CASE WHEN in
+        UPDATE. Full-text and JSON fields can be updated only with REPLACE,
+        so bulk_replace() is used for them.
+
+        :param batch_size: max number of primary keys per query,
+            update_batch_size by default
+        """
+        if batch_size is not None and batch_size <= 0:
+            raise ValueError("Batch size must be a positive integer.")
+        if not fields:
+            raise ValueError("Field names must be given to bulk_update().")
+        objs = tuple(objs)
+        if any(obj.pk is None for obj in objs):
+            raise ValueError(
+                "All bulk_update() objects must have a primary key set.")
+        # noinspection PyProtectedMember
+        fields = [self.model._meta.get_field(name) for name in fields]
+        if any(not f.concrete or f.many_to_many for f in fields):
+            raise ValueError(
+                "bulk_update() can only be used with concrete fields.")
+        if any(f.primary_key for f in fields):
+            raise ValueError(
+                "bulk_update() cannot be used with primary key fields.")
+        if not objs:
+            return 0
+        if any(isinstance(f, (RTField, JSONField)) for f in fields):
+            # rt_field and attr_json can't be updated with UPDATE syntax
+            return self.bulk_replace(
+                objs, batch_size=batch_size or self.update_batch_size)
+
+        batch_size = batch_size or self.update_batch_size
+        self._for_write = True
+        rows_updated = 0
+        for i, field in enumerate(fields):
+            groups = defaultdict(list)
+            values = {}
+            for obj in objs:
+                value = getattr(obj, field.attname)
+                key = make_hashable(value)
+                values.setdefault(key, value)
+                groups[key].append(obj.pk)
+            for key, pks in groups.items():
+                for start in range(0, len(pks), batch_size):
+                    qs = self.filter(pk__in=pks[start:start + batch_size])
+                    updated = qs.update(**{field.attname: values[key]})
+                    if i == 0:
+                        # each object is updated once for every field
+                        rows_updated += updated
+        return rows_updated
+
+    bulk_update.alters_data = True
+
+    def __aiter__(self):
+        async def generator():
+            await self._afetch_all()
+            for item in self._result_cache:
+                yield item
+
+        return generator()
+
+    async def acount(self):
+        """ Performs COUNT(*) query without blocking a thread."""
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        if self.query.is_sliced or self.query.distinct or self.query.combinator:
+            return await sync_to_async(self.count)()
+        query = self.query.chain()
+        query.clear_ordering(True)
+        query.clear_select_clause()
+        query.add_annotation(Count('*'), '__count')
+        row = await self._afetchone(query)
+        return row[0] if row else 0
+
+    async def aget(self, *args, **kwargs):
+        """ Performs get() without blocking a thread."""
+        if self.query.combinator:
+            return await sync_to_async(self.get)(*args, **kwargs)
+        clone = self.filter(*args, **kwargs)
+        if self.query.can_filter():
+            clone = clone.order_by()
+        clone.query.set_limits(high=MAX_GET_RESULTS)
+        await clone._afetch_all()
+        num = len(clone._result_cache)
+        if num == 1:
+            return clone._result_cache[0]
+        # noinspection PyProtectedMember
+        name = self.model._meta.object_name
+        if not num:
+            raise self.model.DoesNotExist(
+                "%s matching query does not exist." % name)
+        raise self.model.MultipleObjectsReturned(
+            "get() returned more than one %s -- it returned %s!" % (
+                name,
+                num if num < MAX_GET_RESULTS else
+                "more than %s" % (MAX_GET_RESULTS - 1),
+            ))
+
+    async def abulk_create(self, objs, batch_size=None,
+                           ignore_conflicts=False, **kwargs):
+        """ Performs bulk_create() without blocking a thread."""
+        if kwargs:
+            # update_conflicts and other new arguments are not supported
+            return await sync_to_async(self.bulk_create)(
+                objs, batch_size, ignore_conflicts, **kwargs)
+        objs = list(objs)
+        if not objs:
+            return objs
+        # noinspection PyProtectedMember
+        fields = self.model._meta.concrete_fields
+        conflicts = REPLACE if ignore_conflicts else {}
+        self._for_write = True
+        objs_with_pk = [obj for obj in objs if obj.pk is not None]
+        objs_without_pk = [obj for obj in objs if obj.pk is None]
+        if objs_with_pk:
+            await self._abatched_insert(
+                objs_with_pk, fields, batch_size, conflicts)
+        if objs_without_pk:
+            fields = [f for f in fields if not isinstance(f, AutoField)]
+            pks = await self._abatched_insert(
+                objs_without_pk, fields, batch_size, conflicts,
+                returning=True)
+            for obj, pk in zip(objs_without_pk, pks):
+                obj.pk = pk
+        for obj in objs:
+            obj._state.adding = False
+            obj._state.db = self.db
+        return objs
+
+    async def adelete(self):
+        """
+        Deletes objects with single DELETE query without blocking a thread.
+
+        If objects can't be deleted with single DELETE ... WHERE statement
+        (i.e. there are delete signal receivers or filters are not a
+        conjunction), usual delete() is called in a thread.
+        """
+        if self.query.is_sliced:
+            raise TypeError("Cannot use 'limit' or 'offset' with delete().")
+        if self._fields is not None:
+            raise TypeError(
+                "Cannot call delete() after .values() or .values_list()")
+        # noinspection PyProtectedMember
+        if (not self.query.where or not is_conjunction(self.query.where) or
+                not Collector(self.db).can_fast_delete(self) or
+                is_distributed(self.model._meta)):
+            # distributed index documents are deleted from each local shard,
+            # other filters are resolved to primary keys by delete()
+            return await sync_to_async(self.delete)()
+        query = self.query.clone()
+        query.__class__ = DeleteQuery
+        compiler = query.get_compiler(using=self.db)
+        statement, params = compiler.as_sql()
+        async with aio.cursor(connections[self.db]) as c:
+            await c.execute(statement, params)
+            deleted = c.rowcount
+        # noinspection PyProtectedMember
+        invalidate(connections[self.db].ops.db_name,
+                   self.model._meta.db_table)
+        self._result_cache = None
+        # noinspection PyProtectedMember
+        return deleted, {self.model._meta.label: deleted}
+
+    async def _afetch_all(self):
+        """ Fills result cache executing query in event loop."""
+        if self._result_cache is not None:
+            return
+        if (self._iterable_class is not ModelIterable or
+                self._prefetch_related_lookups or self.query.select_related or
+                self.query.cache_ttl is not None):
+            # only plain uncached model instances are loaded natively
+            await sync_to_async(self._fetch_all)()
+            return
+        compiler = self.query.get_compiler(using=self.db)
+        try:
+            statement, params = compiler.as_sql()
+        except EmptyResultSet:
+            self._result_cache = []
+            return
+        async with aio.cursor(connections[self.db]) as c:
+            await c.execute(statement, params)
+            rows = await c.fetchall()
+            facet_results = {}
+            for name in compiler.facet_names:
+                await c.nextset()
+                facet_results[name] = [tuple(r) for r in await c.fetchall()]
+            self.query.facet_results = facet_results
+            if self.query.with_meta:
+                await c.execute("SHOW META")
+                self.query.meta = SearchMeta(await c.fetchall())
+        self._result_cache = list(self._iter_objects(compiler, rows))
+
+    async def _afetchone(self, query):
+        compiler = query.get_compiler(using=self.db)
+        try:
+            statement, params = compiler.as_sql()
+        except EmptyResultSet:
+            return None
+        async with aio.cursor(connections[self.db]) as c:
+            await c.execute(statement, params)
+            return await c.fetchone()
+
+    async def _abatched_insert(self, objs, fields, batch_size, conflicts,
+                               returning=False):
+        """ Inserts objects by batches and returns inserted primary keys."""
+        batch_size = batch_size or len(objs)
+        pks = []
+        async with aio.cursor(connections[self.db]) as c:
+            for start in range(0, len(objs), batch_size):
+                query = InsertQuery(self.model, **conflicts)
+                query.insert_values(fields, objs[start:start + batch_size])
+                compiler = query.get_compiler(using=self.db)
+                for statement, params in compiler.as_sql():
+                    await c.execute(statement, params)
+                if returning:
+                    # see ManticoreOperations.fetch_returned_insert_rows
+                    await c.execute("SELECT LAST_INSERT_ID()")
+                    row = await c.fetchone()
+                    pks.extend(map(int, row[0].split(',')))
+        # noinspection PyProtectedMember
+        invalidate(connections[self.db].ops.db_name,
+                   self.model._meta.db_table)
+        return pks
+
+    def _iter_objects(self, compiler, rows):
+        """ Makes model instances from fetched rows like ModelIterable."""
+        select = compiler.select
+        klass_info = compiler.klass_info
+        annotation_col_map = compiler.annotation_col_map
+        model_cls = klass_info['model']
+        select_fields = klass_info['select_fields']
+        start, end = select_fields[0], select_fields[-1] + 1
+        init_list = [f[0].target.attname for f in select[start:end]]
+        if compiler.has_extra_select:
+            rows = [row[:compiler.col_count] for row in rows]
+        for row in compiler.results_iter(results=[rows]):
+            obj = model_cls.from_db(self.db, init_list, row[start:end])
+            if annotation_col_map:
+                for attr_name, col_pos in annotation_col_map.items():
+                    setattr(obj, attr_name, row[col_pos])
+            yield obj
+
+    @staticmethod
+    def _replace_batches(objs, fields, batch_size, max_bytes):
+        """ Splits objects to batches by count and estimated query size."""
+        batch, size = [], 0
+        for obj in objs:
+            # raw instance values are measured, so lazy JSON is not decoded;
+            # string representation is close enough to escaped SQL literal
+            values = obj.__dict__
+            row_size = sum(len(str(values.get(f.attname, ''))) + 4
+                           for f in fields)
+            if batch and (len(batch) >= batch_size or
+                          size + row_size > max_bytes):
+                yield batch
+                batch, size = [], 0
+            batch.append(obj)
+            size += row_size
+        if batch:
+            yield batch
+
     @staticmethod
     def _build_match_expression(*args, **kwargs):
         """ Transforms *args, **kwargs to SphinxQL DSL."""
@@ -49,21 +669,19 @@ class SearchQuerySet(QuerySet):
         terms.extend(map(lambda pair: F(*pair), kwargs.items()))
         return reduce(operator.and_, terms)
 
-    def _match_expression(self) -> Match:
-        """ Gets or adds Match expression to where clause."""
+    def _add_match_expression(self, expression):
+        """ Extends or adds Match expression in where clause."""
         where = self.query.where
         if where.connector != AND:
             raise ValueError(f"MATCH can't be used with {where.connector}")
 
-        for node in where.children:
+        # match nodes are immutable, extended copy replaces existing one
+        for i, node in enumerate(where.children):
             if isinstance(node, Match):
-                match = node
+                where.children[i] = node.add(expression)
                 break
         else:
-            match = Match()
-            where.add(match, AND)
-
-        return match
+            where.add(Match(expression), AND)
 
     def _check_model_fields(self, fields):
         """ Сhecks that the field is in the model """
@@ -77,3 +695,42 @@ class SearchQuerySet(QuerySet):
                 raise ValueError(
                     f'Field is not a full-text field: [{field}]'
                 )
+
+
+class PercolateQuerySet(SearchQuerySet):
+    """ Queryset for stored queries of percolate index."""
+
+    def percolate(self, docs, batch=1000) -> List[List[int]]:
+        """
+        Matches documents against stored queries with CALL PQ.
+
+        Documents are sent by batches, single statement per batch.
+
+        :param docs: iterable of documents as dicts or JSON strings
+        :param batch: number of documents per CALL PQ statement
+        :returns: list of matched stored query ids for each document
+        """
+        connection = connections[self.db]
+        # noinspection PyProtectedMember
+        table = connection.ops.get_table_name(self.model._meta.db_table)
+        docs = iter(docs)
+        result = []
+        while True:
+            chunk = [doc if isinstance(doc, str) else json.dumps(doc)
+                     for doc in islice(docs, batch)]
+            if not chunk:
+                return result
+            placeholders = ', '.join(['%s'] * len(chunk))
+            if len(chunk) > 1:
+                placeholders = f'({placeholders})'
+            matches = [[] for _ in chunk]
+            with connection.cursor() as c:
+                c.execute(f'CALL PQ(%s, {placeholders}, '
+                          f'1 AS docs, 1 AS docs_json)', [table, *chunk])
+                columns = [col[0].lower() for col in c.description]
+                documents = columns.index('documents')
+                for row in c.fetchall():
+                    # documents are numbered from 1 in order of statement
+                    for number in row[documents].split(','):
+                        matches[int(number) - 1].append(row[0])
+            result.extend(matches)
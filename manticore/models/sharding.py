@@ -0,0 +1,75 @@
+"""
+Local shards of distributed indices.
+
+Distributed index is declared with Meta options:
+
+- index_type = 'distributed'
+- local_shards - number of local RT tables named "<db_table>_<n>"
+- agents - list of remote tables like "host:port:table"
+- agent_connect_timeout, agent_query_timeout - remote agent timeouts in ms
+- shard_key - integer field name used for routing writes, primary key by
+  default
+
+Documents are written to local shard chosen by shard key value, search
+queries are performed on distributed table.
+"""
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional
+
+from django.apps import apps
+from django.db.models import Field
+from django.db.models.options import Options
+
+
+def is_distributed(opts: Options) -> bool:
+    return getattr(opts, 'index_type', None) == 'distributed'
+
+
+def get_distributed_options() -> Dict[str, Options]:
+    """ Returns options of installed distributed index models by table."""
+    # noinspection PyProtectedMember
+    return {m._meta.db_table: m._meta for m in apps.get_models()
+            if is_distributed(m._meta)}
+
+
+def get_shard_key_field(opts: Options) -> Field:
+    """ Returns field which value determines local shard of document."""
+    shard_key = getattr(opts, 'shard_key', None)
+    if shard_key is None:
+        return opts.pk
+    return opts.get_field(shard_key)
+
+
+def get_shard_tables(opts: Options,
+                     keys: Optional[Iterable[int]] = None) -> List[str]:
+    """
+    Returns local shard table names of distributed index.
+
+    :param opts: distributed index model options
+    :param keys: shard key values, all shards are returned if None
+    """
+    shards = [f'{opts.db_table}_{n}'
+              for n in range(getattr(opts, 'local_shards', 0))]
+    if keys is None:
+        return shards
+    selected = {get_shard_table(opts, key) for key in keys}
+    return [shard for shard in shards if shard in selected]
+
+
+def get_shard_table(opts: Options, key: Optional[int]) -> str:
+    """ Returns local shard table name for shard key value."""
+    count = getattr(opts, 'local_shards', 0)
+    if not count:
+        raise ValueError(f"{opts.label} has no local shards to write to")
+    if key is None:
+        raise ValueError(f"{opts.label} documents must have shard key set")
+    return f'{opts.db_table}_{int(key) % count}'
+
+
+def group_by_shard(opts: Options, objs: Iterable) -> Dict[str, list]:
+    """ Groups model instances by local shard table name."""
+    attname = get_shard_key_field(opts).attname
+    groups = defaultdict(list)
+    for obj in objs:
+        groups[get_shard_table(opts, getattr(obj, attname))].append(obj)
+    return groups
@@ -1,3 +1,3 @@
-from manticore.models.sql.query import SearchQuery
+from manticore.models.sql.query import Facet, SearchQuery
 
-__all__ = ['SearchQuery']
+__all__ = ['Facet', 'SearchQuery']
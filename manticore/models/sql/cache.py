@@ -0,0 +1,133 @@
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Hashable, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+
+class CompiledQuery(NamedTuple):
+    """ Compiled SELECT template with compiler state needed to read results."""
+    sql: str
+    # parameters from ORDER BY clause, they are determined by query shape
+    order_by_params: Tuple[Any, ...]
+    select: list
+    klass_info: Optional[dict]
+    annotation_col_map: Optional[dict]
+    has_extra_select: bool
+
+
+class CompiledQueryCache:
+    """
+    Bounded LRU cache of compiled SphinxQL templates.
+
+    Keys are structural fingerprints of queries built by SphinxQLCompiler,
+    values are compiled SQL templates which are only re-bound with new
+    parameters on cache hit.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable) -> Optional[CompiledQuery]:
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: CompiledQuery):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """ Drops all cached templates and resets counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        """ Returns hit/miss counters for monitoring."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+
+def get_cache(alias: Optional[str] = None):
+    """
+    Returns cache backend for search results and generation counters.
+    """
+    return caches[alias or getattr(settings, 'MANTICORE_CACHE_BACKEND',
+                                   'default')]
+
+
+def get_generation_key(db_name: str, table: str) -> str:
+    # database name is used instead of alias, so replica aliases share
+    # generation with primary one
+    return f'manticore:generation:{db_name}:{table}'
+
+
+def get_generation(db_name: str, table: str) -> int:
+    """ Returns current generation of cached search results for index."""
+    cache = get_cache()
+    key = get_generation_key(db_name, table)
+    generation = cache.get(key)
+    if generation is None:
+        # After counter eviction generation must not return to any previous
+        # value, so counter starts from current time in microseconds.
+        cache.add(key, time.time_ns() // 1000, timeout=None)
+        generation = cache.get(key)
+    return generation
+
+
+def bump_generation(db_name: str, table: str):
+    """ Makes search results cached for index unreachable."""
+    try:
+        get_cache().incr(get_generation_key(db_name, table))
+    except ValueError:
+        # no results were cached since counter initialization or eviction
+        pass
+
+
+def invalidate(db_name: str, table: str):
+    """
+    Bumps results generation after index write.
+
+    Invalidation may be disabled for write-heavy deployments with
+    MANTICORE_CACHE_INVALIDATION = False, cache backend errors are logged
+    because index is already modified.
+    """
+    if not getattr(settings, 'MANTICORE_CACHE_INVALIDATION', True):
+        return
+    try:
+        bump_generation(db_name, table)
+    except Exception:
+        logger.exception("Failed to invalidate cached results for %s", table)
+
+
+def get_result_key(db_name: str, table: str, sql: str, params) -> str:
+    """ Returns cache key for search query results."""
+    generation = get_generation(db_name, table)
+    digest = hashlib.sha1(repr((sql, tuple(params))).encode()).hexdigest()
+    return f'manticore:results:{db_name}:{table}:{generation}:{digest}'
@@ -1,14 +1,34 @@
+from copy import deepcopy
+from itertools import chain
+
+from django.conf import settings
 from django.core.exceptions import EmptyResultSet
 from django.db import models
 from django.db.backends.mysql import compiler
 from django.db.models import expressions, lookups
+from django.db.models.sql.constants import (
+    GET_ITERATOR_CHUNK_SIZE, MULTI, SINGLE)
 from django.db.models.sql.datastructures import BaseTable
-from django.db.models.sql.where import ExtraWhere, AND
+from django.db.models.sql.where import ExtraWhere, AND, WhereNode
+from django.utils.datastructures import OrderedSet
 
-from manticore.models.lookups import InFunction
+from manticore.models.lookups import InFunction, MultiExact
+from manticore.models.sharding import is_distributed
+from manticore.models.sql.cache import (
+    CompiledQuery, CompiledQueryCache, get_cache, get_result_key)
+from manticore.models.sql.converters import get_batch_converter
+from manticore.models.sql.meta import SearchMeta
 from manticore.models.sql.where import ManticoreWhereNode
 from manticore.sphinxql.expressions import Match
 
+# Lookups whose SQL depends only on rhs type and whose parameters are
+# produced by process_rhs()
+BINDABLE_LOOKUP_SQL = (lookups.BuiltinLookup.as_sql, lookups.Exact.as_sql)
+
+# Compiled SELECT templates shared by all compilers in process
+compiled_query_cache = CompiledQueryCache(
+    getattr(settings, 'MANTICORE_COMPILED_QUERY_CACHE_SIZE', 1024))
+
 
 class SphinxQLCompiler(compiler.SQLCompiler):
 
@@ -25,34 +45,359 @@ class SphinxQLCompiler(compiler.SQLCompiler):
         return super().compile(node)
 
     def as_sql(self, with_limits=True, with_col_aliases=False):
+        sql, params = self.__as_select_sql(with_limits, with_col_aliases)
+        facets = self.__get_facets()
+        if facets:
+            sql = ' '.join([sql, *map(self.__compile_facet, facets)])
+        # names of extra result sets returned by query
+        self.facet_names = [facet.name for facet in facets]
+        return sql, params
+
+    def __as_select_sql(self, with_limits, with_col_aliases):
         self.__maybe_set_limits(with_limits)
+        match = self.__get_match()
+        children = self.__get_where_children(match)
+        key = self.__get_cache_key(
+            children, match, with_limits, with_col_aliases)
+        if key is not None:
+            compiled = compiled_query_cache.get(key)
+            if compiled is not None:
+                return self.__bind(compiled, children, match)
+
         try:
-            self.__maybe_move_where()
+            where = self.__compile_where(children)
         except EmptyResultSet:
             # Where node has compiled to always false condition, but we need
             # to call super().as_sql again for some django internal side effects
-            pass
+            return self.__as_sql(with_limits, with_col_aliases)
+
+        self.__move_where(where, match)
+        sql, params = self.__as_sql(with_limits, with_col_aliases)
+        if key is not None and self.__can_bind(children, where):
+            compiled_query_cache.set(
+                key, self.__get_compiled(sql, params, where, match))
+        return sql, params
+
+    def results_iter(self, results=None, tuple_expected=False,
+                     chunked_fetch=False, chunk_size=GET_ITERATOR_CHUNK_SIZE):
+        """
+        Converts fetched rows column by column for each chunk of results.
+        """
+        if results is None:
+            results = self.execute_sql(
+                MULTI, chunked_fetch=chunked_fetch, chunk_size=chunk_size)
+        fields = [s[0] for s in self.select[0:self.col_count]]
+        converters = self.get_batch_converters(fields)
+        rows = chain.from_iterable(
+            self.apply_batch_converters(chunk, converters)
+            if converters else chunk
+            for chunk in results)
+        if tuple_expected:
+            return map(tuple, rows)
+        return rows
+
+    def get_batch_converters(self, expressions):
+        """
+        Returns list of column position and converters for whole column.
+
+        Converters marked with batch_converter decorator are replaced by
+        their batch versions, others are applied to each value.
+        """
+        converters = []
+        for position, (convs, expression) in self.get_converters(
+                expressions).items():
+            batch_converters = [get_batch_converter(c) for c in convs]
+            converters.append((position, batch_converters, expression))
+        return converters
 
+    def apply_batch_converters(self, rows, converters):
+        if not rows:
+            return rows
+        connection = self.connection
+        columns = list(zip(*rows))
+        for position, batch_converters, expression in converters:
+            values = columns[position]
+            for converter in batch_converters:
+                values = converter(values, expression, connection)
+            columns[position] = values
+        return list(zip(*columns))
+
+    def execute_sql(self, result_type=MULTI, chunked_fetch=False,
+                    chunk_size=GET_ITERATOR_CHUNK_SIZE):
+        if ((getattr(self.query, 'with_meta', False) or self.__get_facets() or
+             getattr(self.query, 'cache_ttl', None) is not None)
+                and result_type in (MULTI, SINGLE)):
+            return self.__execute_batch(result_type)
+        return super().execute_sql(result_type, chunked_fetch, chunk_size)
+
+    def __execute_batch(self, result_type):
+        """
+        Executes search query with facets, optionally followed by SHOW META
+        in a single batch, and stores extra result sets to query.
+
+        For querysets with cache() all result sets are stored in cache.
+        """
+        with_meta = getattr(self.query, 'with_meta', False)
+        try:
+            sql, params = self.as_sql()
+            if not sql:
+                raise EmptyResultSet
+        except EmptyResultSet:
+            self.query.facet_results = {
+                facet.name: [] for facet in self.__get_facets()}
+            if with_meta:
+                self.query.meta = SearchMeta(())
+            return [] if result_type == MULTI else None
+        if with_meta:
+            sql = f'{sql}; SHOW META'
+        ttl = getattr(self.query, 'cache_ttl', None)
+        result = None
+        if ttl is not None:
+            cache = get_cache(self.query.cache_backend)
+            key = get_result_key(self.connection.ops.db_name,
+                                 self.query.get_meta().db_table, sql, params)
+            result = cache.get(key)
+        if result is None:
+            result = self.__fetch(sql, params, with_meta)
+            if ttl is not None:
+                cache.set(key, result, ttl)
+        rows, self.query.facet_results, meta = result
+        if with_meta:
+            self.query.meta = SearchMeta(meta)
+        if self.has_extra_select:
+            rows = [row[:self.col_count] for row in rows]
+        if result_type == SINGLE:
+            return rows[0][:self.col_count] if rows else None
+        return [rows]
+
+    def __fetch(self, sql, params, with_meta):
+        """
+        :returns: search results, facet results and SHOW META rows
+        """
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+            facet_results = {}
+            for name in self.facet_names:
+                cursor.nextset()
+                facet_results[name] = [tuple(r) for r in cursor.fetchall()]
+            meta = ()
+            if with_meta:
+                cursor.nextset()
+                meta = cursor.fetchall()
+        return list(rows), facet_results, meta
+
+    def __as_sql(self, with_limits, with_col_aliases):
         sql, params = super().as_sql(with_limits, with_col_aliases)
         if getattr(self.query, 'options', False):
-            options, options_params = [], []
-            for k, v in self.query.options.items():
-                if hasattr(v, 'as_sql'):
-                    v_sql, v_params = v.as_sql(self, self.connection)
-                    options.append(f'{k} = {v_sql}')
-                    options_params.extend(v_params)
-                elif isinstance(v, dict):
-                    dict_option, dict_params = self._compile_dict(v)
-                    options.append(f'{k} = ({dict_option})')
-                    options_params.extend(dict_params)
-                else:
-                    options.append(f'{k} = %s')
-                    options_params.append(v)
-            options_sql = ', '.join(options)
+            options_sql, options_params = self.__compile_options()
             sql = f'{sql} OPTION {options_sql}'
             params += tuple(options_params)
         return sql, params
 
+    def __compile_options(self):
+        options, options_params = [], []
+        for k, v in self.query.options.items():
+            if hasattr(v, 'as_sql'):
+                v_sql, v_params = v.as_sql(self, self.connection)
+                options.append(f'{k} = {v_sql}')
+                options_params.extend(v_params)
+            elif isinstance(v, dict):
+                dict_option, dict_params = self._compile_dict(v)
+                options.append(f'{k} = ({dict_option})')
+                options_params.extend(dict_params)
+            else:
+                options.append(f'{k} = %s')
+                options_params.append(v)
+        return ', '.join(options), options_params
+
+    def __get_facets(self):
+        """ Returns facets for search query, aggregations have no facets."""
+        facets = getattr(self.query, 'facets', None)
+        if not facets:
+            return []
+        for annotation in self.query.annotations.values():
+            if getattr(annotation, 'contains_aggregate', False):
+                return []
+        return facets
+
+    def __compile_facet(self, facet):
+        qn = self.connection.ops.quote_name
+        sql = f'FACET {qn(facet.column)}'
+        if facet.order_by:
+            name = facet.order_by.lstrip('-')
+            expression = 'COUNT(*)' if name == 'count' else qn(facet.column)
+            direction = 'DESC' if facet.order_by.startswith('-') else 'ASC'
+            sql = f'{sql} ORDER BY {expression} {direction}'
+        if facet.limit is not None:
+            sql = f'{sql} LIMIT {int(facet.limit)}'
+        return sql
+
+    def __get_cache_key(self, children, match, with_limits,
+                        with_col_aliases):
+        """
+        Returns structural fingerprint of a query or None if query can't be
+        compiled from cached template.
+
+        Fingerprint contains everything that affects SQL text but not
+        parameter values: filtering conditions are represented with their
+        tree structure without compiling it, match expression with it's
+        presence.
+        """
+        query = self.query
+        if (query.annotations or query.extra or query.group_by is not None or
+                query.combinator or query.subquery or query.distinct or
+                query.select_related or query.select_for_update or
+                getattr(query, 'explain_info', None) or
+                getattr(query, 'explain_query', False) or
+                len(query.alias_map) > 1):
+            # annotations, joins and other complex queries are compiled
+            # without cache.
+            return None
+        shapes = tuple(map(self.__get_where_shape, children))
+        if None in shapes:
+            return None
+        where = (query.where.connector, query.where.negated, shapes)
+        options = []
+        for k, v in getattr(query, 'options', {}).items():
+            if hasattr(v, 'as_sql'):
+                # expressions are compared by their identity
+                options.append((k, v))
+            elif isinstance(v, dict):
+                options.append((k, tuple(v)))
+            else:
+                options.append((k, None))
+        names, defer = query.deferred_loading
+        ops = self.connection.ops
+        key = (
+            self.__class__,
+            self.connection.alias, ops.db_name, ops.cluster_name,
+            query.model,
+            query.default_cols, tuple(query.select), query.values_select,
+            frozenset(names), defer,
+            tuple(query.order_by), tuple(query.extra_order_by),
+            query.default_ordering, query.standard_ordering,
+            query.low_mark, query.high_mark,
+            with_limits, with_col_aliases,
+            where, match is not None,
+            tuple(options),
+        )
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def __get_where_shape(self, node):
+        """
+        Returns hashable structure of filtering condition or None if
+        parameters of condition can't be bound without compiling it.
+        """
+        if isinstance(node, WhereNode):
+            children = tuple(map(self.__get_where_shape, node.children))
+            if not children or None in children:
+                return None
+            return node.__class__, node.connector, node.negated, children
+        if (not isinstance(node, lookups.BuiltinLookup) or
+                not isinstance(node.lhs, expressions.Col) or
+                not node.rhs_is_direct_value()):
+            # transforms, expressions and subqueries are compiled every time
+            return None
+        if (hasattr(node, f'as_{self.connection.vendor}') or
+                not isinstance(node, (lookups.In, MultiExact)) and
+                type(node).as_sql not in BINDABLE_LOOKUP_SQL):
+            # SQL of lookups like isnull depends on rhs value
+            return None
+        rhs = node.rhs
+        if isinstance(node, lookups.In):
+            try:
+                size = len(OrderedSet(rhs))
+            except TypeError:  # Unhashable items in rhs
+                size = len(rhs)
+            if not size:
+                # always false condition
+                return None
+        elif isinstance(rhs, (list, tuple)):
+            size = len(rhs)
+        else:
+            size = None
+        return node.__class__, node.lhs.target, type(rhs), size
+
+    def __get_where_params(self, node):
+        """ Returns parameters of filtering condition without compiling it."""
+        if isinstance(node, WhereNode):
+            return list(chain.from_iterable(
+                map(self.__get_where_params, node.children)))
+        if isinstance(node, MultiExact):
+            node = InFunction(node.lhs, [node.rhs])
+        elif isinstance(node, lookups.In):
+            node = InFunction(node.lhs, node.rhs)
+        # column has no parameters, see __compile_col
+        return list(node.process_rhs(self, self.connection)[1])
+
+    def __can_bind(self, children, where):
+        """
+        Checks that parameters of freshly compiled conditions are the same as
+        bound without compiling.
+        """
+        if not children:
+            return where is None
+        if where is None or not where[0]:
+            return False
+        params = chain.from_iterable(map(self.__get_where_params, children))
+        return list(params) == list(where[1])
+
+    def __get_params(self, where, match):
+        """ Returns parameters for __where__ expression and match clause."""
+        params = []
+        if where:
+            # __where__ expression in select clause and __where__ = %s
+            params.extend(where[1])
+            params.append(True)
+        if match:
+            params.extend(match.as_sql(self, self.connection)[1])
+        return params
+
+    def __get_compiled(self, sql, params, where, match) -> CompiledQuery:
+        """ Makes template from freshly compiled query."""
+        prefix = len(self.__get_params(where, match))
+        if getattr(self.query, 'options', False):
+            suffix = len(self.__compile_options()[1])
+        else:
+            suffix = 0
+        return CompiledQuery(
+            sql=sql,
+            order_by_params=tuple(params[prefix:len(params) - suffix]),
+            select=self.select,
+            klass_info=self.klass_info,
+            annotation_col_map=self.annotation_col_map,
+            has_extra_select=self.has_extra_select,
+        )
+
+    def __bind(self, compiled: CompiledQuery, children, match):
+        """ Binds parameters of current query to cached template."""
+        # state used for reading results, normally set in pre_sql_setup;
+        # copied so that compilers don't share mutable state
+        self.select = list(compiled.select)
+        self.klass_info = deepcopy(compiled.klass_info)
+        self.annotation_col_map = (
+            None if compiled.annotation_col_map is None else
+            dict(compiled.annotation_col_map))
+        self.col_count = len(compiled.select)
+        self.has_extra_select = compiled.has_extra_select
+
+        params = []
+        if children:
+            params.extend(chain.from_iterable(
+                map(self.__get_where_params, children)))
+            params.append(True)
+        if match:
+            params.extend(match.as_sql(self, self.connection)[1])
+        params.extend(compiled.order_by_params)
+        if getattr(self.query, 'options', False):
+            params.extend(self.__compile_options()[1])
+        return compiled.sql, tuple(params)
+
     def __compile_col(self, node: expressions.Col):
         qn = self.quote_name_unless_alias
         return qn(node.target.column), ()
@@ -60,20 +405,36 @@ class SphinxQLCompiler(compiler.SQLCompiler):
     def __compile_table(self, node: BaseTable):
         qn = self.connection.ops.quote_name
         table_name = self.connection.ops.mark_table_name(node.table_name)
+        if is_distributed(self.query.get_meta()):
+            # distributed table is not replicated by cluster, it performs
+            # search on local shards and remote agents
+            table_name = self.connection.ops.mark_table_name(str(table_name))
+            table_name.skip_cluster = True
         return qn(table_name), ()
 
-    def __maybe_move_where(self):
-        where = self.query.where.clone()
-        match = None
-        for node in where.children:
+    def __get_match(self):
+        for node in self.query.where.children:
             if isinstance(node, Match):
-                match = node
-                break
-        if match:
-            where.children.remove(match)
+                return node
+        return None
+
+    def __get_where_children(self, match):
+        """ Returns filtering conditions except match clause."""
+        return [node for node in self.query.where.children
+                if node is not match]
+
+    def __compile_where(self, children):
+        """ Compiles filtering conditions except match clause."""
+        if not children:
+            return None
+        where = self.query.where
+        where = where.__class__(children, where.connector, where.negated)
+        return self.compile(where)
+
+    def __move_where(self, where, match):
         if not where:
             return
-        sql, params = self.compile(where)
+        sql, params = where
         extra_select = expressions.RawSQL(sql, params, models.BooleanField())
         extra_where = ExtraWhere(['__where__ = %s'], (True,))
         where = ManticoreWhereNode()
@@ -0,0 +1,34 @@
+from functools import partial
+from typing import Callable, List
+
+
+def batch_converter(name: str) -> Callable:
+    """
+    Marks single value converter as having batch version.
+
+    :param name: name of converter owner method which converts a whole
+        column of values at once.
+    """
+    def decorator(func):
+        func.batch_converter = name
+        return func
+    return decorator
+
+
+def convert_each(converter, values, expression, connection) -> List:
+    """ Applies single value converter to a column of values."""
+    return [converter(value, expression, connection) for value in values]
+
+
+def get_batch_converter(converter: Callable) -> Callable:
+    """
+    Returns batch version of single value converter.
+
+    Converters marked with batch_converter are replaced with named method of
+    same object, others are applied to each value.
+    """
+    name = getattr(converter, 'batch_converter', None)
+    owner = getattr(converter, '__self__', None)
+    if name is None or owner is None:
+        return partial(convert_each, converter)
+    return getattr(owner, name)
@@ -0,0 +1,38 @@
+from typing import Iterable, NamedTuple, Tuple
+
+
+class Keyword(NamedTuple):
+    """ Per-keyword statistics."""
+    keyword: str
+    docs: int
+    hits: int
+
+
+class SearchMeta:
+    """ Search query statistics returned by SHOW META."""
+
+    def __init__(self, rows: Iterable[Tuple[str, str]]):
+        self.values = dict(rows)
+        self.total = int(self.values.get('total', 0))
+        self.total_found = int(self.values.get('total_found', 0))
+        # since manticore-4.2 total_found may be a lower bound
+        self.total_relation = self.values.get('total_relation', 'eq')
+        self.time = float(self.values.get('time', 0))
+        self.keywords = []
+        i = 0
+        while f'keyword[{i}]' in self.values:
+            self.keywords.append(Keyword(
+                keyword=self.values[f'keyword[{i}]'],
+                docs=int(self.values.get(f'docs[{i}]', 0)),
+                hits=int(self.values.get(f'hits[{i}]', 0)),
+            ))
+            i += 1
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}: total_found={self.total_found} '
+                f'time={self.time}')
+
+    @property
+    def exact(self) -> bool:
+        """ total_found is an exact number of matched documents."""
+        return self.total_relation == 'eq'
@@ -1,16 +1,40 @@
+from typing import NamedTuple, Optional
+
 from django.db.models import sql
 
 from manticore.models.sql.where import ManticoreWhereNode
 
 
+class Facet(NamedTuple):
+    """ FACET clause definition."""
+    name: str
+    column: str
+    # "count" or facet field name, optionally prefixed with "-"
+    order_by: Optional[str]
+    limit: Optional[int]
+
+
 class SearchQuery(sql.Query):
     def __init__(self, model, where=ManticoreWhereNode, alias_cols=True):
         super().__init__(model, alias_cols=alias_cols)
         self.where = where()
         self.where_class = where
         self.options = {}
+        # fetch SHOW META after search query
+        self.with_meta = False
+        # SHOW META results of evaluated query
+        self.meta = None
+        self.facets = []
+        # facet name -> list of (value, count) of evaluated query
+        self.facet_results = None
+        # search results cache timeout and backend alias
+        self.cache_ttl = None
+        self.cache_backend = None
 
     def clone(self):
         query = super().clone()
         query.options = self.options.copy()
+        query.meta = None
+        query.facets = list(self.facets)
+        query.facet_results = None
         return query
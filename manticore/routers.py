@@ -1,6 +1,9 @@
+import random
+
 from django.apps import apps
 from django.conf import settings
 
+from manticore.backend.stats import query_stats
 from manticore.models import base
 
 
@@ -16,10 +19,35 @@ def is_search_index(model_or_obj):
 # noinspection PyUnusedLocal
 class ManticoreRouter:
     db_name = getattr(settings, 'MANTICORE_DATABASE_NAME', 'manticore')
+    # database aliases used for reading search indices
+    read_db_names = getattr(settings, 'MANTICORE_READ_DATABASE_NAMES', None)
+    # probability of choosing random alias to refresh it's statistics
+    exploration_rate = 0.05
+    # latency multiplier for alias failing all queries
+    error_penalty = 10.0
 
     def db_for_read(self, model, **hints):
         if is_search_index(model):
-            return self.db_name
+            return self.choose_read_db()
+
+    def choose_read_db(self):
+        """
+        Chooses read alias with lowest moving average of query latency
+        penalized by error rate.
+        """
+        aliases = self.read_db_names or [self.db_name]
+        if len(aliases) == 1:
+            return aliases[0]
+        if random.random() < self.exploration_rate:
+            return random.choice(aliases)
+        return min(aliases, key=self.get_score)
+
+    def get_score(self, alias):
+        stats = query_stats.get(alias)
+        if stats.latency is None:
+            # alias without successful queries is tried first unless it fails
+            return stats.error_rate * self.error_penalty
+        return stats.latency * (1 + stats.error_rate * self.error_penalty)
 
     def db_for_write(self, model, **hints):
         if is_search_index(model):
@@ -3,25 +3,113 @@ This module contains base classes for SphinxQL domain language.
 """
 
 from typing import Tuple, Iterable, Any
+from weakref import WeakValueDictionary
 
+# structural key -> canonical node instance
+_interned = WeakValueDictionary()
 
-class SphinxQLNode:
+
+def intern(node):
+    """ Returns canonical instance of structurally equal node."""
+    if not isinstance(node, SphinxQLExpression):
+        return node
+    return _interned.setdefault(node.identity, node)
+
+
+class SphinxQLExpression:
+    """
+    Immutable base class for SphinxQL graph elements.
+
+    Nodes are compared and hashed by structure and memoize rendered
+    SphinxQL, so that shared subtrees are rendered once per process.
+    """
+    __slots__ = ('_identity', '_hash', '_sphinxql', '__weakref__')
+
+    def _set(self, **attrs):
+        for name, value in attrs.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def _get_identity(self) -> tuple:
+        """ Returns tuple of values defining node structure."""
+        raise NotImplementedError
+
+    @property
+    def identity(self) -> tuple:
+        identity = getattr(self, '_identity', None)
+        if identity is None:
+            identity = (self.__class__, *self._get_identity())
+            self._set(_identity=identity)
+        return identity
+
+    def __eq__(self, other):
+        if not isinstance(other, SphinxQLExpression):
+            return NotImplemented
+        return self is other or self.identity == other.identity
+
+    def __hash__(self):
+        value = getattr(self, '_hash', None)
+        if value is None:
+            value = hash(self.identity)
+            self._set(_hash=value)
+        return value
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self._get_slots()
+                if not name.startswith('_') and hasattr(self, name)}
+
+    def __setstate__(self, state):
+        self._set(**state)
+
+    @classmethod
+    def _get_slots(cls):
+        for klass in cls.__mro__:
+            yield from getattr(klass, '__slots__', ())
+
+    def as_sphinxql(self) -> Tuple[str, Iterable[Any]]:
+        rendered = getattr(self, '_sphinxql', None)
+        if rendered is None:
+            sql, params = self._as_sphinxql()
+            rendered = (sql, tuple(params))
+            self._set(_sphinxql=rendered)
+        sql, params = rendered
+        return sql, list(params)
+
+    def _as_sphinxql(self) -> Tuple[str, Iterable[Any]]:
+        raise NotImplementedError
+
+
+class SphinxQLNode(SphinxQLExpression):
     """
     SphinxQL non-leaf node.
 
     SphinxQLNode implements a node that combines child nodes with same connector.
     """
+    __slots__ = ('expressions', 'connector')
+
     AND = "&"
     OR = "|"
     MAYBE = "MAYBE"  # Lazy OR
 
-    connector = AND
-
     def __init__(self, *expressions, connector=AND):
-        self.expressions = list(expressions)
-        self.connector = connector
+        self._set(expressions=tuple(map(intern, expressions)),
+                  connector=connector)
 
-    def as_sphinxql(self):
+    def _get_identity(self):
+        return (self.connector, *self.expressions)
+
+    def _as_sphinxql(self):
         sphinxql = []
         params = []
         for expr in self.expressions:
@@ -76,7 +164,7 @@ class SphinxQLNode:
         return self._combine(other, self.OR, True)
 
 
-class SphinxQLCombinable:
+class SphinxQLCombinable(SphinxQLExpression):
     """
     Leaf node class for SphinxQL graph.
 
@@ -84,6 +172,8 @@ class SphinxQLCombinable:
 
     It does not provide __init__ signature to allow any signature for child classes.
     """
+    __slots__ = ()
+
     node_class = SphinxQLNode
 
     def __and__(self, other):
@@ -102,9 +192,6 @@ class SphinxQLCombinable:
         parts = [other, self] if reverse else [self, other]
         return self.node_class(*parts, connector=connector)
 
-    def as_sphinxql(self) -> Tuple[str, Iterable[Any]]:
-        raise NotImplementedError
-
     def __repr__(self):
         sql, params = self.as_sphinxql()
         return f'{self.__class__.__name__}: {sql % tuple(params)}'
@@ -4,7 +4,8 @@ This module contains public interface for SphinxQL domain language.
 
 from typing import Optional, Union
 
-from manticore.sphinxql.base import SphinxQLCombinable, SphinxQLNode, escape
+from manticore.sphinxql.base import (SphinxQLCombinable, SphinxQLNode, escape,
+                                     intern)
 
 __all__ = [
     'F',
@@ -16,6 +17,7 @@ __all__ = [
 
 class TextNode(SphinxQLNode):
     """ Node allowing operations with text terms."""
+    __slots__ = ()
 
 
 class T(SphinxQLCombinable):
@@ -29,6 +31,8 @@ class T(SphinxQLCombinable):
     - negate
 
     """
+    __slots__ = ('term', 'negate', 'exact', 'prefix', 'start')
+
     node_class = TextNode
 
     def __init__(self, term: str, negate=False, exact=False, prefix=False, start=False):
@@ -44,17 +48,17 @@ class T(SphinxQLCombinable):
         """
         if not isinstance(term, str):
             raise TypeError("term is not string")
-        self.term = term
-        self.negate = negate
-        self.exact = exact
-        self.prefix = prefix
-        self.start = start
+        self._set(term=term, negate=negate, exact=exact, prefix=prefix,
+                  start=start)
 
     def __invert__(self):
         return self.__class__(self.term, negate=not self.negate,
                               exact=self.exact)
 
-    def as_sphinxql(self):
+    def _get_identity(self):
+        return self.term, self.negate, self.exact, self.prefix, self.start
+
+    def _as_sphinxql(self):
         p = ''
         if self.exact:
             p = '='
@@ -83,6 +87,7 @@ class P(T):
     >>> ~P("exact word forms", exact=True)
     P: !(="exact word forms")
     """
+    __slots__ = ('proximity', 'quorum')
 
     def __init__(self, term: str, negate=False, exact=False,
                  proximity: Optional[int] = None,
@@ -91,18 +96,22 @@ class P(T):
         if proximity is not None:
             if not isinstance(proximity, int):
                 raise TypeError("proximity must be int")
-        self.proximity = proximity
         if quorum is not None:
             if not isinstance(quorum, (int, float)):
                 raise TypeError("quorum must be int or float")
-        self.quorum = quorum
+        self._set(proximity=proximity, quorum=quorum)
 
     def __invert__(self):
         return self.__class__(self.term, negate=not self.negate,
                               exact=self.exact, proximity=self.proximity,
                               quorum=self.quorum)
 
-    def as_sphinxql(self):
+    def _get_identity(self):
+        # quorum type is significant: /1 and /1.0 are rendered differently
+        return (*super()._get_identity(), self.proximity, self.quorum,
+                type(self.quorum))
+
+    def _as_sphinxql(self):
         if isinstance(self.quorum, int):
             m = f'/{self.quorum}'
         elif isinstance(self.quorum, float):
@@ -124,6 +133,7 @@ class F(SphinxQLCombinable):
     - @field text -
 
     """
+    __slots__ = ('fields', 'expression', 'exclude')
 
     def __init__(self, *args, exclude=False, **kwargs):
         """
@@ -156,18 +166,17 @@ class F(SphinxQLCombinable):
         else:
             raise ValueError("Pass args or kwargs")
 
-        self.fields = field_names
         if isinstance(expression, str):
-            self.expression = T(expression)
-        elif isinstance(expression, T):
-            self.expression = expression
-        elif isinstance(expression, TextNode):
-            self.expression = expression
-        else:
+            expression = T(expression)
+        elif not isinstance(expression, (T, TextNode)):
             raise TypeError("unsupported expression for F")
-        self.exclude = exclude
+        self._set(fields=tuple(field_names), expression=intern(expression),
+                  exclude=exclude)
+
+    def _get_identity(self):
+        return self.fields, self.expression, self.exclude
 
-    def as_sphinxql(self):
+    def _as_sphinxql(self):
         if len(self.fields) == 1:
             fields = self.fields[0]
         else:
@@ -180,15 +189,21 @@ class F(SphinxQLCombinable):
 
 class Match(SphinxQLNode):
     """ Root match node that renders MATCH(...) """
+    __slots__ = ('_expression',)
+
     # duck typing for Django ORM
     contains_aggregate = False
 
-    def add(self, *expressions):
-        """ Inplace extending match query."""
-        self.expressions.extend(expressions)
+    def add(self, *expressions) -> "Match":
+        """ Returns new match node extended with expressions."""
+        return self.__class__(*self.expressions, *expressions,
+                              connector=self.connector)
 
     # noinspection PyUnusedLocal
     def as_sql(self, compiler, connection):
-        sphinxql, params = self.as_sphinxql()
-        expression = sphinxql % tuple(map(escape, params))
+        expression = getattr(self, '_expression', None)
+        if expression is None:
+            sphinxql, params = self.as_sphinxql()
+            expression = sphinxql % tuple(map(escape, params))
+            self._set(_expression=expression)
         return f"MATCH(%s)", [expression]
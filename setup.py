@@ -71,6 +71,10 @@ setup(
     install_requires=[
         'Django>=3.1,<4.3',
     ],
+    extras_require={
+        'async': ['aiomysql'],
+        'orjson': ['orjson'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Console',
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.9 on 2026-10-17 12:00
+
+from django.db import migrations, models
+import manticore.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testapp', '0002_djangomodel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PercolateModel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('query', manticore.models.fields.PercolateQueryField()),
+                ('tags', models.CharField(blank=True, default='', max_length=255)),
+                ('filters', models.CharField(blank=True, default='', max_length=255)),
+            ],
+            options={
+                'abstract': False,
+                'index_type': 'pq',
+                'document_fields': {'title': 'text', 'color': 'string'},
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.9 on 2026-10-17 12:00
+
+from django.db import migrations, models
+import manticore.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testapp', '0003_percolatemodel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DistributedModel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', manticore.models.fields.RTField(default='')),
+                ('attr_uint', models.IntegerField(default=0)),
+            ],
+            options={
+                'index_type': 'distributed',
+                'local_shards': 2,
+            },
+        ),
+    ]
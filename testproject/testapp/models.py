@@ -1,7 +1,7 @@
 from django.db import models
 from django.utils import timezone
 
-from manticore.models import fields, SearchIndex
+from manticore.models import fields, PercolateIndex, SearchIndex
 
 
 class FieldMixin(models.Model):
@@ -24,8 +24,29 @@ class FieldMixin(models.Model):
 
 
 class TestModel(FieldMixin, SearchIndex):
-    pass
+
+    @classmethod
+    def get_source_queryset(cls):
+        return DjangoModel.objects.all()
+
+    @classmethod
+    def from_source(cls, obj):
+        return cls(pk=obj.pk, sphinx_field=obj.title)
 
 
 class DjangoModel(models.Model):
     title = models.CharField(max_length=32)
+
+
+class PercolateModel(PercolateIndex):
+    class Meta(PercolateIndex.Meta):
+        document_fields = {'title': 'text', 'color': 'string'}
+
+
+class DistributedModel(SearchIndex):
+    class Meta:
+        index_type = 'distributed'
+        local_shards = 2
+
+    title = fields.RTField()
+    attr_uint = models.IntegerField(default=0)
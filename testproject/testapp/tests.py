@@ -1,14 +1,32 @@
+import json
+import os
+from array import array
+import tempfile
 from copy import deepcopy
 from datetime import timedelta
+from functools import wraps
+from io import StringIO
+from unittest import mock
 
 import django
-from django.db import connections
-from django.db.models import Value, OrderBy
+from django.apps import apps
+from django.core.management import call_command
+from django.db import ProgrammingError, connections, transaction
+from django.db.models import IntegerField, Value, OrderBy, Q, signals
 from django.test import utils
 from django.utils import timezone
 from django_testing_utils.mixins import BaseTestCase
 
+from manticore.backend import aio, base
+from manticore.backend.pool import ConnectionPool, Host, LEAST_OUTSTANDING
+from manticore.backend.stats import query_stats
+from manticore.indexer import WriteBehindIndexer
+from manticore.management.commands import manticore_reindex as reindex
+from manticore.models import SearchQuerySet, fields, sharding
+from manticore.models.fields import LazyJSONAttribute
 from manticore.models.functions import Expr, Export, Weight
+from manticore.models.sql.compiler import compiled_query_cache
+from manticore.models.sql.where import ManticoreWhereNode
 from manticore.routers import ManticoreRouter, is_search_index
 from manticore.sphinxql.expressions import F, T, P
 from testproject.testapp import models
@@ -247,6 +265,55 @@ class SearchIndexTestCase(SearchIndexTestCaseBase):
         self.assertTrue(sql.startswith('TRUNCATE RTINDEX '))
         self.assertEqual(self.model.objects.count(), 0)
 
+    def test_filtered_delete(self):
+        """ Filters and MATCH are compiled into single DELETE statement."""
+        other = self.model.objects.create(**{**self.defaults, 'attr_uint': 1})
+        qs = self.model.objects.match('hello').filter(attr_uint=1)
+
+        with utils.CaptureQueriesContext(connections['manticore']) as ctx:
+            deleted, _ = qs.delete()
+
+        self.assertEqual(deleted, 1)
+        statements = [q['sql'] for q in ctx.captured_queries
+                      if not q['sql'].startswith(('BEGIN', 'COMMIT'))]
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith('DELETE FROM '))
+        self.assertIn('MATCH(', statements[0])
+        self.assertFalse(self.model.objects.filter(pk=other.pk).exists())
+        self.assertTrue(self.model.objects.filter(pk=self.obj.pk).exists())
+
+    def test_delete_by_ids(self):
+        """ Disjunction of filters is deleted by primary keys."""
+        objs = [self.model.objects.create(**{**self.defaults, 'attr_uint': i})
+                for i in range(3)]
+        qs = self.model.objects.filter(Q(attr_uint=0) | Q(attr_uint=2))
+
+        deleted, _ = qs.delete()
+
+        self.assertEqual(deleted, 2)
+        self.assertEqual(
+            list(self.model.objects.order_by('pk').values_list(
+                'pk', flat=True)),
+            sorted([self.obj.pk, objs[1].pk]))
+
+    def test_delete_with_signals(self):
+        """ Delete signals are sent for each deleted document."""
+        deleted_pks = []
+
+        def receiver(instance, **kwargs):
+            deleted_pks.append(instance.pk)
+
+        signals.post_delete.connect(receiver, sender=self.model)
+        self.addCleanup(signals.post_delete.disconnect, receiver,
+                        sender=self.model)
+
+        deleted, rows_count = self.model.objects.filter(
+            attr_uint=self.obj.attr_uint).delete()
+
+        self.assertEqual(deleted, 1)
+        self.assertEqual(rows_count, {self.model._meta.label: 1})
+        self.assertEqual(deleted_pks, [self.obj.pk])
+
     def test_bulk_create(self):
         """ bulk_creates sets primary key value."""
         objs = [self.model(**self.defaults) for _ in range(10)]
@@ -276,6 +343,84 @@ class SearchIndexTestCase(SearchIndexTestCaseBase):
         self.model.objects.bulk_create(objs)
         self.assertIsNotNone(objs[0].pk)
 
+    def test_bulk_replace(self):
+        """ bulk_replace updates indexed fields with multi-row REPLACE."""
+        objs = [self.model(**self.defaults) for _ in range(6)]
+        self.model.objects.bulk_create(objs)
+        objs = list(self.model.objects.all())
+        new_values = self.get_new_field_values()
+        for obj in objs:
+            for k, v in new_values.items():
+                setattr(obj, k, v)
+
+        with utils.CaptureQueriesContext(connections['manticore']) as ctx:
+            count = self.model.objects.bulk_replace(objs, batch_size=3)
+
+        self.assertEqual(count, 7)
+        self.assertEqual(len(ctx.captured_queries), 3)
+        for query in ctx.captured_queries:
+            self.assertTrue(query['sql'].startswith('REPLACE INTO '))
+        expected = {**self.defaults, **new_values}
+        for obj in objs:
+            self.assert_object_fields(obj, **expected)
+        self.assertEqual(self.model.objects.count(), 7)
+
+    def test_bulk_replace_requires_pk(self):
+        """ bulk_replace can't create objects without primary key."""
+        with self.assertRaises(ValueError):
+            self.model.objects.bulk_replace([self.model(**self.defaults)])
+
+    def test_bulk_update_attributes(self):
+        """ bulk_update groups objects by new attribute value."""
+        objs = [self.model(**self.defaults) for _ in range(5)]
+        self.model.objects.bulk_create(objs)
+        objs.append(self.obj)
+        for i, obj in enumerate(objs):
+            obj.attr_uint = i % 2
+            obj.attr_multi = [1, 2] if i % 2 else [3]
+
+        with utils.CaptureQueriesContext(connections['manticore']) as ctx:
+            updated = self.model.objects.bulk_update(
+                objs, ['attr_uint', 'attr_multi'], batch_size=2)
+
+        self.assertEqual(updated, 6)
+        # 2 distinct values per field, 3 objects per value, 2 per batch
+        self.assertEqual(len(ctx.captured_queries), 8)
+        sql = ctx.captured_queries[0]['sql']
+        self.assertTrue(sql.startswith('UPDATE '))
+        self.assertIn(' WHERE `id` IN (', sql)
+        for i, obj in enumerate(objs):
+            self.assert_object_fields(
+                obj, attr_uint=i % 2, attr_multi=[1, 2] if i % 2 else [3])
+
+    def test_bulk_update_default_batch_size(self):
+        """ bulk_update splits primary keys by update_batch_size."""
+        objs = [self.model(**self.defaults) for _ in range(4)]
+        self.model.objects.bulk_create(objs)
+        objs.append(self.obj)
+        for obj in objs:
+            obj.attr_uint = 1
+
+        with mock.patch.object(SearchQuerySet, 'update_batch_size', 2):
+            with utils.CaptureQueriesContext(connections['manticore']) as ctx:
+                updated = self.model.objects.bulk_update(objs, ['attr_uint'])
+
+        self.assertEqual(updated, 5)
+        # single value, 5 objects, 2 per batch
+        self.assertEqual(len(ctx.captured_queries), 3)
+        for obj in objs:
+            self.assert_object_fields(obj, attr_uint=1)
+
+    def test_bulk_update_indexed_fields(self):
+        """ bulk_update uses REPLACE for full-text and JSON fields."""
+        new_values = self.get_new_field_values()
+        for k, v in new_values.items():
+            setattr(self.obj, k, v)
+
+        self.model.objects.bulk_update([self.obj], list(new_values))
+
+        self.assert_object_fields(self.obj, **{**self.defaults, **new_values})
+
     def assert_match(self, qs, sphinxql, escape=True):
         if escape:
             escape = connections['manticore'].connection.literal
@@ -301,6 +446,24 @@ class SearchIndexTestCase(SearchIndexTestCaseBase):
         qs = qs.match("sphinx")
         self.assert_match(qs, "((hello) & (sphinx))")
 
+    def test_match_does_not_change_source_queryset(self):
+        """ Subsequent match call leaves original match expression intact."""
+        qs = self.model.objects.match("hello")
+        qs.match("sphinx")
+        self.assert_match(qs, "(hello)")
+
+    def test_match_expressions_immutable(self):
+        """ SphinxQL nodes are immutable and compared by structure."""
+        first = T("hello") & ~P("sphinx search", quorum=2)
+        second = T("hello") & ~P("sphinx search", quorum=2)
+
+        self.assertEqual(first, second)
+        self.assertEqual(hash(first), hash(second))
+        self.assertIs(first.expressions[0], second.expressions[0])
+        self.assertNotEqual(P("search", quorum=1), P("search", quorum=1.0))
+        with self.assertRaises(AttributeError):
+            first.connector = first.OR
+
     def test_match_multiple_terms(self):
         """ passing space-separated text is not split to words."""
         qs = self.model.objects.match("hello sphinx")
@@ -485,6 +648,451 @@ class SearchIndexTestCase(SearchIndexTestCaseBase):
         sql = ctx.captured_queries[-1]['sql']
         self.assertIn(" ORDER BY weight() DESC ", sql)
 
+    def test_compiled_query_cache(self):
+        """ Queries of same shape are compiled once and re-bound."""
+        compiled_query_cache.clear()
+        qs = self.model.objects.match("hello").filter(
+            attr_uint=self.obj.attr_uint).order_by('-attr_bigint')
+        with utils.CaptureQueriesContext(connections['manticore']) as ctx:
+            self.assertListEqual(list(qs), [self.obj])
+        first = ctx.captured_queries[-1]['sql']
+        self.assertEqual(compiled_query_cache.stats()['misses'], 1)
+
+        qs = self.model.objects.match("sphinx").filter(
+            attr_uint=self.obj.attr_uint + 1).order_by('-attr_bigint')
+        # filtering conditions are not compiled on cache hit
+        with mock.patch.object(ManticoreWhereNode, 'as_sql',
+                               side_effect=AssertionError):
+            with utils.CaptureQueriesContext(
+                    connections['manticore']) as ctx:
+                self.assertListEqual(list(qs), [])
+        second = ctx.captured_queries[-1]['sql']
+        self.assertEqual(compiled_query_cache.stats()['hits'], 1)
+        self.assertNotEqual(first, second)
+        self.assertEqual(first.replace('hello', 'sphinx').replace(
+            str(self.obj.attr_uint), str(self.obj.attr_uint + 1)), second)
+
+        qs = self.model.objects.match("sphinx").filter(
+            attr_uint=self.obj.attr_uint).order_by('-attr_bigint')
+        self.assertListEqual(list(qs), [self.obj])
+        values = list(self.model.objects.filter(
+            attr_uint=self.obj.attr_uint).values_list('attr_uint', flat=True))
+        self.assertListEqual(values, [self.obj.attr_uint])
+
+        # compiler state is not shared between queries
+        first, second = [qs.query.get_compiler('manticore') for _ in range(2)]
+        first.as_sql()
+        second.as_sql()
+        self.assertIsNot(first.select, second.select)
+        self.assertIsNot(first.klass_info, second.klass_info)
+
+        # SQL of isnull depends on value, so it is compiled every time
+        for value, expected in ((True, ' IS NULL'), (False, ' IS NOT NULL')):
+            qs = self.model.objects.filter(attr_uint__isnull=value)
+            sql, _ = qs.query.get_compiler('manticore').as_sql()
+            self.assertIn(expected, sql)
+
+    def test_meta(self):
+        """ SHOW META is fetched with search query on demand."""
+        qs = self.model.objects.match('hello').with_meta()
+        with utils.CaptureQueriesContext(connections['manticore']) as ctx:
+            self.assertListEqual(list(qs), [self.obj])
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertTrue(ctx.captured_queries[0]['sql'].endswith('; SHOW META'))
+
+        meta = qs.meta
+        self.assertEqual(meta.total_found, 1)
+        self.assertTrue(meta.exact)
+        self.assertEqual(meta.keywords[0].keyword, 'hello')
+        self.assertEqual(meta.keywords[0].docs, 1)
+
+    def test_meta_opt_in(self):
+        """ SHOW META is not requested by default."""
+        qs = self.model.objects.match('hello')
+        with utils.CaptureQueriesContext(connections['manticore']) as ctx:
+            list(qs)
+        self.assertNotIn('SHOW META', ctx.captured_queries[0]['sql'])
+        self.assertIsNone(qs.meta)
+
+    def test_page(self):
+        """ Page with total is fetched in a single round trip."""
+        self.model.objects.bulk_create(
+            [self.model(**self.defaults) for _ in range(4)])
+        qs = self.model.objects.match('hello').order_by('id')
+
+        with utils.CaptureQueriesContext(connections['manticore']) as ctx:
+            page = qs.page(1, 2)
+
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(len(page.objects), 2)
+        self.assertListEqual(page.objects, list(qs)[1:3])
+        self.assertEqual(page.total, 5)
+        self.assertTrue(page.exact)
+
+    def test_page_max_matches(self):
+        """ max_matches is increased for deep pages."""
+        with utils.CaptureQueriesContext(connections['manticore']) as ctx:
+            page = self.model.objects.page(1000, 10)
+        self.assertIn('max_matches = 1010', ctx.captured_queries[0]['sql'])
+        self.assertListEqual(page.objects, [])
+        self.assertEqual(page.total, 1)
+
+    def test_facets(self):
+        """ Facets are returned with search results in one query."""
+        for _ in range(2):
+            self.model.objects.create(**{**self.defaults, 'attr_uint': 1})
+        qs = self.model.objects.match('hello').facet(
+            'attr_uint', order_by='-count', limit=5).facet('attr_bool')
+
+        with utils.CaptureQueriesContext(connections['manticore']) as ctx:
+            objs = list(qs)
+
+        self.assertEqual(len(ctx.captured_queries), 1)
+        sql = ctx.captured_queries[0]['sql']
+        self.assertIn(' FACET `attr_uint` ORDER BY COUNT(*) DESC LIMIT 5', sql)
+        self.assertTrue(sql.endswith(' FACET `attr_bool`'))
+        self.assertEqual(len(objs), 3)
+        self.assertEqual(qs.facets, {
+            'attr_uint': [(1, 2), (self.obj.attr_uint, 1)],
+            'attr_bool': [(1, 3)],
+        })
+        self.assertEqual(qs.count(), 3)
+
+    def test_facet_validation(self):
+        """ Facet ordering is count or facet field."""
+        with self.assertRaises(ValueError):
+            self.model.objects.facet('attr_uint', order_by='attr_bool')
+        with self.assertRaises(ValueError):
+            self.model.objects.facet('attr_uint').facet('attr_uint')
+
+    def test_facet_alias(self):
+        """ Multiple facets by same field are keyed by alias."""
+        for _ in range(2):
+            self.model.objects.create(**{**self.defaults, 'attr_uint': 1})
+        qs = self.model.objects.facet('attr_uint', order_by='attr_uint').facet(
+            'attr_uint', order_by='-count', limit=1, alias='top_uint')
+
+        list(qs)
+
+        self.assertEqual(qs.facets, {
+            'attr_uint': [(1, 2), (self.obj.attr_uint, 1)],
+            'top_uint': [(1, 2)],
+        })
+
+    def test_cache(self):
+        """ Cached search results are invalidated by index writes."""
+        qs = self.model.objects.match('hello').cache(ttl=60)
+        self.assertEqual(list(qs.all()), [self.obj])
+
+        with utils.CaptureQueriesContext(connections['manticore']) as ctx:
+            self.assertEqual(list(qs.all()), [self.obj])
+        self.assertEqual(len(ctx.captured_queries), 0)
+
+        self.model.objects.filter(pk=self.obj.pk).update(attr_uint=1)
+
+        with utils.CaptureQueriesContext(connections['manticore']) as ctx:
+            objs = list(qs.all())
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertEqual(objs[0].attr_uint, 1)
+
+    @utils.override_settings(MANTICORE_CACHE_INVALIDATION=False)
+    def test_cache_invalidation_disabled(self):
+        """ Cached search results expire by ttl if invalidation is off."""
+        qs = self.model.objects.match('hello').cache(ttl=60)
+        self.assertEqual(list(qs.all()), [self.obj])
+
+        self.model.objects.filter(pk=self.obj.pk).update(attr_uint=1)
+
+        with utils.CaptureQueriesContext(connections['manticore']) as ctx:
+            objs = list(qs.all())
+        self.assertEqual(len(ctx.captured_queries), 0)
+        self.assertEqual(objs[0].attr_uint, self.obj.attr_uint)
+
+    def test_batch_converters(self):
+        """ Column converters match per-value converters."""
+        connection = connections['manticore']
+        for name, values in (
+                ('attr_multi', ['1,2,3', '', None]),
+                ('attr_multi_64', [f'{2 ** 33},{2 ** 34}', '']),
+                ('attr_json', ['{"json": "test"}', '[]', None])):
+            field = self.model._meta.get_field(name)
+            expected = [field.from_db_value(v, field, connection)
+                        for v in values]
+            self.assertEqual(
+                field.from_db_values(values, field, connection), expected)
+
+        obj = self.model.objects.values_list(
+            'attr_multi', 'attr_json', 'attr_timestamp').get(pk=self.obj.pk)
+        self.assertEqual(obj, (self.defaults['attr_multi'],
+                               self.defaults['attr_json'], self.now))
+
+    def test_compact_multi_fields(self):
+        """ Multi-value attributes may be returned and passed as arrays."""
+        connection = connections['manticore']
+        for field, typecode in ((fields.MultiField(compact=True), 'I'),
+                                (fields.BigMultiField(compact=True), 'q')):
+            self.assertEqual(field.from_db_value('1,2', field, connection),
+                             array(typecode, [1, 2]))
+            self.assertEqual(
+                field.from_db_values(['1,2', ''], field, connection),
+                [array(typecode, [1, 2]), array(typecode)])
+
+        obj = self.model.objects.create(
+            **{**self.defaults, 'attr_multi': array('I', [4, 5]),
+               'attr_multi_64': array('q', [2 ** 35])})
+
+        self.assert_object_fields(obj, attr_multi=[4, 5],
+                                  attr_multi_64=[2 ** 35])
+        qs = self.model.objects.filter(attr_multi=array('I', [5]))
+        self.assertEqual(list(qs), [obj])
+
+    def test_lazy_json_field(self):
+        """ Lazy JSON is decoded on attribute access with custom loads."""
+        field = fields.JSONField(lazy=True, loads=json.loads,
+                                 dumps=lambda v: json.dumps(v).encode())
+        field.set_attributes_from_name('attr_json')
+        holder = type('Holder', (), {'attr_json': LazyJSONAttribute(field)})()
+        connection = connections['manticore']
+
+        value = field.from_db_value('{"json": "test"}', field, connection)
+        self.assertIsInstance(value, fields.RawJSON)
+        self.assertEqual(field.get_prep_value(value), '{"json": "test"}')
+        holder.__dict__['attr_json'] = value
+        self.assertEqual(holder.attr_json, {'json': 'test'})
+        self.assertEqual(field.get_prep_value({'a': 1}), '{"a": 1}')
+        self.assertEqual(field.deconstruct()[3]['lazy'], True)
+
+        holder.__dict__['attr_json'] = value
+        self.assertIs(field.pre_save(holder, False), value)
+        self.assertIsInstance(holder.__dict__['attr_json'], fields.RawJSON)
+
+    def test_replace_batches_lazy_json(self):
+        """ Batch size is estimated without decoding lazy JSON."""
+        field = fields.JSONField(lazy=True)
+        field.set_attributes_from_name('attr_json')
+        holder = type('Holder', (), {'attr_json': LazyJSONAttribute(field)})()
+        holder.__dict__['attr_json'] = fields.RawJSON('{"a": 1}')
+
+        # 8 characters and 4 for quotes and separator per row
+        batches = list(SearchQuerySet._replace_batches(
+            [holder, holder], [field], batch_size=10, max_bytes=20))
+
+        self.assertEqual(len(batches), 2)
+        self.assertIsInstance(holder.__dict__['attr_json'], fields.RawJSON)
+
+    def test_ids(self):
+        """ ids() returns primary keys array preserving ordering."""
+        other = self.model.objects.create(**{**self.defaults, 'attr_uint': 1})
+        qs = self.model.objects.match('hello').options(max_matches=10)
+
+        with utils.CaptureQueriesContext(connections['manticore']) as ctx:
+            ids = qs.order_by('attr_uint').ids()
+
+        self.assertEqual(ids, array('q', [other.pk, self.obj.pk]))
+        sql = ctx.captured_queries[0]['sql']
+        self.assertIn('MATCH(', sql)
+        self.assertIn('OPTION max_matches = 10', sql)
+
+    def test_raw_rows(self):
+        """ raw_rows() returns unconverted tuples without __where__."""
+        qs = self.model.objects.filter(attr_uint__gt=0).raw_rows(
+            'pk', 'attr_multi', 'attr_timestamp')
+
+        rows = list(qs)
+
+        self.assertEqual(rows, [(self.obj.pk, '1,2,3',
+                                 int(self.now.timestamp()))])
+        self.assertEqual(len(list(self.model.objects.raw_rows())[0]),
+                         len(self.model._meta.concrete_fields))
+
+    def test_hydrate(self):
+        """ Model objects are fetched by chunks in search results order."""
+        sources = [models.DjangoModel.objects.create(title=f'title {i}')
+                   for i in range(3)]
+        for i, obj in enumerate(sources):
+            self.model.objects.create(
+                **{**self.defaults, 'pk': obj.pk, 'attr_uint': 10 - i})
+        missing = sources.pop(1)
+        missing.delete()
+        qs = self.model.objects.match('hello').filter(attr_uint__lte=10)
+        qs = qs.order_by('attr_uint')
+
+        with utils.CaptureQueriesContext(connections['default']) as ctx:
+            result = list(qs.hydrate(models.DjangoModel, chunk_size=2))
+
+        self.assertEqual([obj for obj, _ in result], sources[::-1])
+        self.assertTrue(all(weight > 0 for _, weight in result))
+        self.assertEqual(len(ctx.captured_queries), 2)
+        result = list(qs.hydrate(models.DjangoModel, on_missing='none'))
+        self.assertEqual([obj for obj, _ in result],
+                         [sources[1], None, sources[0]])
+        with self.assertRaises(models.DjangoModel.DoesNotExist):
+            list(qs.hydrate(models.DjangoModel, on_missing='raise'))
+
+    def test_stream(self):
+        """ stream() iterates over all results with keyset pagination."""
+        objs = [self.model(**self.defaults) for _ in range(10)]
+        self.model.objects.bulk_create(objs)
+        self.model.objects.create(**{**self.defaults, 'attr_uint': 1})
+        expected = sorted([self.obj.pk] + [obj.pk for obj in objs])
+        qs = self.model.objects.match('hello').filter(
+            attr_uint=self.defaults['attr_uint'])
+
+        with utils.CaptureQueriesContext(connections['manticore']) as ctx:
+            result = [obj.pk for obj in qs.stream(batch_size=3)]
+
+        self.assertListEqual(result, expected)
+        self.assertEqual(len(ctx.captured_queries), 4)
+        sql = ctx.captured_queries[-1]['sql']
+        self.assertIn(' ORDER BY `id` ASC LIMIT 3 OPTION max_matches = 3', sql)
+
+
+def close_pools(func):
+    """ Closes connection pools bound to event loop of async test."""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            await aio.close_pools()
+    return wrapper
+
+
+class AsyncSearchIndexTestCase(SearchIndexTestCaseBase):
+
+    def test_pool_params_host(self):
+        """ Node of multi-host pool overrides HOST and PORT settings."""
+        params = aio.get_pool_params(connections['manticore'],
+                                     Host('replica', 9312))
+        self.assertEqual((params['host'], params['port']), ('replica', 9312))
+        self.assertNotIn('unix_socket', params)
+
+    @close_pools
+    async def test_aiter(self):
+        """ Search results are fetched natively in async for."""
+        qs = self.model.objects.match('hello').filter(
+            attr_uint=self.obj.attr_uint)
+        result = [obj async for obj in qs]
+        self.assertListEqual(result, [self.obj])
+        self.assertEqual(result[0].attr_multi, self.defaults['attr_multi'])
+        self.assertEqual(result[0].attr_timestamp, self.now)
+
+    @close_pools
+    async def test_acount(self):
+        """ COUNT(*) is performed natively."""
+        self.assertEqual(await self.model.objects.acount(), 1)
+        qs = self.model.objects.filter(attr_uint=self.obj.attr_uint + 1)
+        self.assertEqual(await qs.acount(), 0)
+
+    @close_pools
+    async def test_aget(self):
+        """ Single object is fetched natively."""
+        obj = await self.model.objects.aget(pk=self.obj.pk)
+        self.assertEqual(obj, self.obj)
+        with self.assertRaises(self.model.DoesNotExist):
+            await self.model.objects.aget(attr_uint=0)
+
+    @close_pools
+    async def test_abulk_create_and_adelete(self):
+        """ Objects are inserted and deleted natively."""
+        objs = [self.model(**self.defaults) for _ in range(3)]
+        await self.model.objects.abulk_create(objs)
+        for obj in objs:
+            self.assertIsNotNone(obj.pk)
+        self.assertEqual(await self.model.objects.acount(), 4)
+
+        pks = [obj.pk for obj in objs]
+        deleted, _ = await self.model.objects.filter(pk__in=pks).adelete()
+
+        self.assertEqual(deleted, 3)
+        self.assertEqual(await self.model.objects.acount(), 1)
+
+    @close_pools
+    async def test_adelete_disjunction(self):
+        """ Filters not compiled to DELETE ... WHERE are resolved to ids."""
+        other = self.model(**{**self.defaults, 'attr_uint': 2})
+        await self.model.objects.abulk_create([other])
+        qs = self.model.objects.filter(Q(attr_uint=self.obj.attr_uint) |
+                                       Q(attr_uint=other.attr_uint))
+
+        deleted, _ = await qs.adelete()
+
+        self.assertEqual(deleted, 2)
+        self.assertEqual(await self.model.objects.acount(), 0)
+
+
+class FakeConnection:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.closed = False
+
+    def ping(self):
+        if self.closed:
+            raise ConnectionError()
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTestCase(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.hosts = [('node1', 9306), ('node2', 9306), ('node3', 9306)]
+        self.down = set()
+
+    def connect(self, host, port):
+        if host in self.down:
+            raise ConnectionError(host)
+        return FakeConnection(host, port)
+
+    def test_round_robin(self):
+        """ Connections are spread over all nodes."""
+        pool = ConnectionPool(self.hosts)
+        hosts = [pool.acquire(self.connect)[1].host for _ in range(3)]
+        self.assertListEqual(hosts, ['node1', 'node2', 'node3'])
+
+    def test_least_outstanding(self):
+        """ Node with least checked out connections is chosen."""
+        pool = ConnectionPool(self.hosts, strategy=LEAST_OUTSTANDING)
+        host, conn = pool.acquire(self.connect)
+        pool.acquire(self.connect)
+        pool.release(host, conn)
+        self.assertEqual(pool.acquire(self.connect)[1].host, 'node3')
+        self.assertEqual(pool.acquire(self.connect)[1].host, host.host)
+
+    def test_reuse_idle_connection(self):
+        """ Released connections are reused."""
+        pool = ConnectionPool(self.hosts[:1])
+        host, conn = pool.acquire(self.connect)
+        pool.release(host, conn)
+        self.assertIs(pool.acquire(self.connect)[1], conn)
+
+        pool.release(host, conn, broken=True)
+        self.assertTrue(conn.closed)
+        self.assertIsNot(pool.acquire(self.connect)[1], conn)
+
+    def test_health_check(self):
+        """ Dead idle connections are dropped on checkout."""
+        pool = ConnectionPool(self.hosts[:1], health_check_interval=0)
+        host, conn = pool.acquire(self.connect)
+        pool.release(host, conn)
+        conn.closed = True
+        self.assertIsNot(pool.acquire(self.connect)[1], conn)
+
+    def test_mark_down(self):
+        """ Failing node is skipped until backoff expires."""
+        pool = ConnectionPool(self.hosts, backoff=60)
+        self.down.add('node1')
+        hosts = [pool.acquire(self.connect)[1].host for _ in range(4)]
+        self.assertNotIn('node1', hosts)
+        self.assertTrue(pool.hosts[0].is_down)
+
+        self.down = {'node1', 'node2', 'node3'}
+        with self.assertRaises(ConnectionError):
+            pool.acquire(self.connect)
+
 
 class ManticoreRouterTestCase(BaseTestCase):
     databases = {'default', 'manticore'}
@@ -506,6 +1114,39 @@ class ManticoreRouterTestCase(BaseTestCase):
         self.assertEqual(self.router.db_for_read(self.test_model), 'manticore')
         self.assertIsNone(self.router.db_for_read(self.django_model))
 
+    def test_db_for_read_replicas(self):
+        """ Read alias is chosen by observed latency and error rate."""
+        query_stats.reset()
+        self.addCleanup(query_stats.reset)
+        self.router.read_db_names = ['manticore', 'replica']
+        self.router.exploration_rate = 0
+
+        query_stats.observe('manticore', 0.05)
+        # replica without statistics is tried first
+        self.assertEqual(self.router.db_for_read(self.test_model), 'replica')
+
+        query_stats.observe('replica', 0.01)
+        self.assertEqual(self.router.db_for_read(self.test_model), 'replica')
+
+        for _ in range(10):
+            query_stats.observe('replica', 0.01, error=True)
+        self.assertEqual(self.router.db_for_read(self.test_model), 'manticore')
+        self.assertEqual(self.router.db_for_write(self.test_model), 'manticore')
+
+    def test_latency_tracking(self):
+        """ Queries to manticore database are tracked."""
+        query_stats.reset()
+        self.addCleanup(query_stats.reset)
+        with connections['manticore'].cursor() as cursor:
+            cursor.execute("SHOW TABLES")
+        # latency is measured for SELECT queries only
+        self.assertIsNone(query_stats.get('manticore').latency)
+
+        list(models.TestModel.objects.all())
+        stats = query_stats.get('manticore')
+        self.assertGreaterEqual(stats.queries, 1)
+        self.assertIsNotNone(stats.latency)
+
     def test_db_for_write(self):
         self.assertEqual(self.router.db_for_write(self.test_model), 'manticore')
         self.assertIsNone(self.router.db_for_write(self.django_model))
@@ -536,6 +1177,346 @@ class ManticoreRouterTestCase(BaseTestCase):
             'manticore', 'testapp', 'DjangoModel'))
 
 
+class ManticoreReindexTestCase(SearchIndexTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.sources = [models.DjangoModel.objects.create(title=f'title {i}')
+                        for i in range(3)]
+
+    def reindex(self, **kwargs):
+        stdout = StringIO()
+        call_command('manticore_reindex', 'testapp.TestModel', batch_size=2,
+                     stdout=stdout, **kwargs)
+        return stdout.getvalue()
+
+    def test_reindex(self):
+        """ Source objects are copied to search index."""
+        output = self.reindex()
+
+        for obj in self.sources:
+            doc = self.model.objects.get(pk=obj.pk)
+            self.assertEqual(doc.sphinx_field, obj.title)
+        self.assertIn("3 objects indexed", output)
+
+    def test_get_ranges(self):
+        """ Primary key ranges are computed from range boundaries only."""
+        pks = [obj.pk for obj in self.sources]
+
+        ranges = reindex.Command.get_ranges(self.model, None, 2)
+
+        self.assertEqual(ranges, [(None, pks[1]), (pks[1], pks[2])])
+        self.assertEqual(reindex.Command.get_ranges(self.model, pks[2], 2),
+                         [])
+
+    def test_resume(self):
+        """ Reindex continues after primary key stored in checkpoint."""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        reindex.Command.write_checkpoint(
+            path, 'testapp.TestModel', self.sources[0].pk)
+
+        self.reindex(checkpoint=path, resume=True)
+
+        self.assertFalse(
+            self.model.objects.filter(pk=self.sources[0].pk).exists())
+        self.assertEqual(
+            self.model.objects.filter(
+                pk__in=[obj.pk for obj in self.sources[1:]]).count(), 2)
+        with open(path) as f:
+            self.assertEqual(json.load(f)['last_pk'], self.sources[-1].pk)
+
+
+class WriteBehindIndexerTestCase(SearchIndexTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.indexer = WriteBehindIndexer()
+        self.other = self.model.objects.create(**self.defaults)
+
+    def test_coalesce_operations(self):
+        """ Operations are coalesced by pk and written after commit."""
+        with utils.CaptureQueriesContext(connections['manticore']) as ctx:
+            with transaction.atomic():
+                for value in (1, 2):
+                    self.indexer.upsert(self.model(
+                        **{**self.defaults, 'pk': self.obj.pk,
+                           'attr_uint': value}))
+                self.indexer.delete(self.model, self.other.pk)
+                self.assertEqual(len(ctx.captured_queries), 0)
+
+        self.assertEqual(len(ctx.captured_queries), 2)
+        self.assertTrue(ctx.captured_queries[0]['sql'].startswith('REPLACE'))
+        self.assert_object_fields(self.obj, attr_uint=2)
+        self.assertFalse(self.model.objects.filter(pk=self.other.pk).exists())
+        stats = self.indexer.stats()
+        self.assertEqual(stats['pending'], 0)
+        self.assertEqual(stats['flushes'], 1)
+        self.assertEqual(stats['items_flushed'], 2)
+
+    def test_rollback(self):
+        """ Operations of rolled back transaction are discarded."""
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                self.indexer.delete(self.model, self.obj.pk)
+                raise ValueError()
+
+        self.assertTrue(self.model.objects.filter(pk=self.obj.pk).exists())
+        self.assertEqual(self.indexer.stats()['pending'], 0)
+
+    def test_nested_savepoints(self):
+        """ Last operation wins across nested savepoints."""
+        with transaction.atomic():
+            for value, nested in ((1, False), (2, True), (3, False)):
+                with transaction.atomic(savepoint=nested):
+                    self.indexer.upsert(self.model(
+                        **{**self.defaults, 'pk': self.obj.pk,
+                           'attr_uint': value}))
+
+        self.assert_object_fields(self.obj, attr_uint=3)
+
+    def test_flush_error(self):
+        """ Failed flush is logged and operations are kept for retry."""
+        with mock.patch.object(self.indexer, '_write',
+                               side_effect=ConnectionError()):
+            with self.assertLogs('manticore.indexer', 'ERROR'):
+                with transaction.atomic():
+                    self.indexer.delete(self.model, self.obj.pk)
+
+        stats = self.indexer.stats()
+        self.assertEqual(stats['pending'], 1)
+        self.assertEqual(stats['errors'], 1)
+
+        self.indexer.flush()
+        self.assertFalse(self.model.objects.filter(pk=self.obj.pk).exists())
+
+
+class SchemaEditorTestCase(SearchIndexTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.objs = [self.model.objects.create(**self.defaults)
+                     for _ in range(4)]
+        self.connection = connections['manticore']
+        self.field = IntegerField(default=7)
+        self.field.set_attributes_from_name('attr_new')
+        settings_dict = {**self.connection.settings_dict,
+                         'BACKFILL_BATCH_SIZE': 2}
+        patcher = mock.patch.object(self.connection, 'settings_dict',
+                                    settings_dict)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_values(self):
+        ops = self.connection.ops
+        table = ops.quote_name(ops.mark_table_name(self.model._meta.db_table))
+        with self.connection.cursor() as c:
+            c.execute(f'SELECT id, attr_new FROM {table} ORDER BY id ASC')
+            return dict(c.fetchall())
+
+    def add_field(self):
+        with utils.CaptureQueriesContext(self.connection) as ctx:
+            with self.connection.schema_editor() as editor:
+                editor.add_field(self.model, self.field)
+        return [q['sql'] for q in ctx.captured_queries
+                if q['sql'].startswith('UPDATE')]
+
+    def test_add_field_backfill(self):
+        """ Default value is set by batches of ids and may be resumed."""
+        updates = self.add_field()
+        self.addCleanup(self.remove_field)
+
+        # 5 rows are updated by 2 + 2 + 1
+        self.assertEqual(len(updates), 3)
+        self.assertEqual(set(self.get_values().values()), {7})
+
+        pks = sorted(self.get_values())
+        with self.connection.schema_editor() as editor:
+            checkpoint = editor._get_backfill_checkpoint(self.model,
+                                                         self.field)
+            editor._write_backfill_checkpoint(checkpoint, pks[2])
+        # rows after checkpoint are not backfilled yet, except one written
+        # by application during backfill
+        ops = self.connection.ops
+        table = ops.quote_name(ops.mark_table_name(self.model._meta.db_table))
+        with self.connection.cursor() as c:
+            c.execute(f'UPDATE {table} SET attr_new = 0 WHERE id > %s',
+                      [pks[2]])
+            c.execute(f'UPDATE {table} SET attr_new = 5 WHERE id = %s',
+                      [pks[3]])
+        self.field.default = 8
+
+        self.add_field()
+
+        values = self.get_values()
+        self.assertEqual([values[pk] for pk in pks], [7, 7, 7, 5, 8])
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def remove_field(self):
+        with self.connection.schema_editor() as editor:
+            editor.remove_field(self.model, self.field)
+
+    def test_add_field_stale_checkpoint(self):
+        """ Checkpoint is ignored if column doesn't exist."""
+        with self.connection.schema_editor() as editor:
+            checkpoint = editor._get_backfill_checkpoint(self.model,
+                                                         self.field)
+            editor._write_backfill_checkpoint(checkpoint, 0)
+
+        self.add_field()
+        self.addCleanup(self.remove_field)
+
+        self.assertEqual(set(self.get_values().values()), {7})
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_table_list_cache(self):
+        """ SHOW TABLES result is cached in schema editor until DDL."""
+        introspection = self.connection.introspection
+        with self.connection.schema_editor() as editor:
+            introspection.table_names()
+            with utils.CaptureQueriesContext(self.connection) as ctx:
+                names = introspection.table_names()
+            self.assertEqual(len(ctx.captured_queries), 0)
+            self.assertIn(self.model._meta.db_table, names)
+
+            editor.add_field(self.model, self.field)
+            self.addCleanup(self.remove_field)
+
+            with utils.CaptureQueriesContext(self.connection) as ctx:
+                introspection.table_names()
+            self.assertEqual(len(ctx.captured_queries), 1)
+
+            # backfill updates don't reset cache
+            ops = self.connection.ops
+            table = ops.quote_name(
+                ops.mark_table_name(self.model._meta.db_table))
+            with utils.CaptureQueriesContext(self.connection) as ctx:
+                editor.execute(f'UPDATE {table} SET attr_uint = 1 WHERE id = 0')
+                introspection.table_names()
+            self.assertEqual(len(ctx.captured_queries), 1)
+
+        # cache is not used outside of schema editor
+        with utils.CaptureQueriesContext(self.connection) as ctx:
+            introspection.table_names()
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+    def test_migrate_table_list_cache(self):
+        """ SHOW TABLES result is cached for whole migrate run."""
+        introspection = self.connection.introspection
+        app_config = apps.get_app_config('testapp')
+        signals.pre_migrate.send(app_config, app_config=app_config,
+                                 using='manticore')
+        self.addCleanup(introspection.end_migrate_cache)
+        introspection.table_names()
+        with utils.CaptureQueriesContext(self.connection) as ctx:
+            introspection.table_names()
+        self.assertEqual(len(ctx.captured_queries), 0)
+
+        signals.post_migrate.send(app_config, app_config=app_config,
+                                  using='manticore')
+        with utils.CaptureQueriesContext(self.connection) as ctx:
+            introspection.table_names()
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+    @mock.patch('manticore.backend.schema.add_to_cluster')
+    def test_group_cluster_add(self, add_to_cluster):
+        """ Tables created by migration are added to cluster at once."""
+        with self.connection.schema_editor() as editor:
+            editor._add_to_cluster('`first`')
+            editor._add_to_cluster('`second`')
+            add_to_cluster.assert_not_called()
+
+        add_to_cluster.assert_called_once_with(
+            mock.ANY, '`cluster`', ['`first`', '`second`'])
+
+
+class PercolateIndexTestCase(BaseTestCase):
+    databases = {'manticore'}
+
+    def test_percolate(self):
+        """ Documents are matched against stored queries by batches."""
+        model = models.PercolateModel
+        shoes = model.objects.create(query=F(title=T('shoes')))
+        red = model.objects.create(query='@title red', tags='color')
+        docs = [{'title': 'red shoes'}, '{"title": "red hat"}',
+                {'title': 'blue dress'}]
+
+        with utils.CaptureQueriesContext(connections['manticore']) as ctx:
+            result = model.objects.percolate(iter(docs), batch=2)
+
+        self.assertEqual(len(ctx.captured_queries), 2)
+        self.assertEqual([sorted(ids) for ids in result],
+                         [[shoes.pk, red.pk], [red.pk], []])
+
+
+class DistributedIndexTestCase(BaseTestCase):
+    databases = {'manticore'}
+
+    def setUp(self):
+        super().setUp()
+        self.model = models.DistributedModel
+        self.connection = connections['manticore']
+        self.model.objects.bulk_create([
+            self.model(pk=pk, title=f'title {pk}', attr_uint=pk)
+            for pk in range(1, 6)])
+
+    def get_shard_ids(self):
+        ops = self.connection.ops
+        result = []
+        with self.connection.cursor() as c:
+            for shard in sharding.get_shard_tables(self.model._meta):
+                c.execute(f'SELECT id FROM {ops.get_table_name(shard)} '
+                          f'ORDER BY id ASC')
+                result.append([row[0] for row in c.fetchall()])
+        return result
+
+    def test_writes_routed_to_shards(self):
+        """ Documents are written to local shard chosen by primary key."""
+        self.assertEqual(self.get_shard_ids(), [[2, 4], [1, 3, 5]])
+        self.assertEqual(self.model.objects.match('title').count(), 5)
+
+        with utils.CaptureQueriesContext(self.connection) as ctx:
+            self.model.objects.filter(pk=3).update(attr_uint=10)
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+        updated = self.model.objects.filter(attr_uint__gte=4).update(
+            attr_uint=0)
+        self.assertEqual(updated, 3)
+
+        deleted, _ = self.model.objects.filter(pk__in=[1, 2]).delete()
+        self.assertEqual(deleted, 2)
+        self.assertEqual(self.get_shard_ids(), [[4], [3, 5]])
+        self.assertEqual(
+            list(self.model.objects.values_list('attr_uint', flat=True)
+                 .order_by('id')),
+            [0, 0, 0])
+
+
+class CreationTestCase(BaseTestCase):
+    databases = {'manticore'}
+
+    def setUp(self):
+        super().setUp()
+        self.connection = connections['manticore']
+        settings_dict = {**self.connection.settings_dict, 'DDL_WORKERS': 4}
+        patcher = mock.patch.object(self.connection, 'settings_dict',
+                                    settings_dict)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_execute_parallel(self):
+        """ Test database statements are executed by thread pool."""
+        creation = self.connection.creation
+        with mock.patch('manticore.backend.base.ThreadPoolExecutor',
+                        wraps=base.ThreadPoolExecutor) as executor:
+            creation._execute_parallel(["SHOW TABLES"] * 10)
+        executor.assert_called_once_with(4)
+
+        with self.assertRaises(ProgrammingError):
+            creation._execute_parallel(["SHOW TABLES", "DROP TABLE missing"])
+
+
 class NonTransactionalTestCase(BaseTestCase):
     databases = {'default', 'manticore'}
 